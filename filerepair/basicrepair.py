@@ -28,9 +28,10 @@ import os
 import sys
 import argparse
 import itertools
-import hashlib
 import multiprocessing as mp
 
+import cksums
+
 def DefaultOpts():
 	opts = {
 		# what cksum algo was used
@@ -45,7 +46,7 @@ def DefaultOpts():
 	return opts
 
 def calc_one_cksum( cksum_algo, data ):
-	algo = hashlib.new( cksum_algo )
+	algo = cksums.new_cksum( cksum_algo )
 	algo.update( data )
 	return algo.hexdigest()
 
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+#
+# (C) 2015-2016, John Pormann, Duke University, jbp1@duke.edu
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#	The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+# per-block cksum algorithms .. we only need to catch media errors, not
+# attackers, so the cheap non-cryptographic ones are a good deal faster
+# (and smaller) than SHA1
+#
+# anything that hashlib.new knows about still works; on top of that we
+# register (upper-case names):
+#   'CRC32', 'ADLER32'             = zlib, 4 bytes
+#   'CRC32C'                       = if the crc32c module is installed, 4 bytes
+#   'XXH64', 'XXH3_64', 'XXH3_128' = if the xxhash module is installed
+#   'BLAKE2B-64', 'BLAKE2B-128'    = BLAKE2b cut down to 8 or 16 bytes
+
+import hashlib
+import zlib
+import time
+
+try:
+	import crc32c
+except ImportError:
+	crc32c = None
+
+try:
+	import xxhash
+except ImportError:
+	xxhash = None
+
+# name -> (constructor, digest_size)
+algo_registry = {}
+
+def register_algo( name, new_fn, digest_size ):
+	algo_registry[ name.upper() ] = ( new_fn, digest_size )
+	return 0
+
+# wraps a running-value checksum function fn(data,value) in the hashlib
+# interface (update, digest, hexdigest)
+class RunningCksum:
+	def __init__( self, fn, nbytes=4 ):
+		self.fn = fn
+		self.nbytes = nbytes
+		self.value = fn( b'' )
+
+	def update( self, data ):
+		self.value = self.fn( data, self.value )
+
+	def digest( self ):
+		return self.value.to_bytes( self.nbytes, 'big' )
+
+	def hexdigest( self ):
+		return self.digest().hex()
+
+register_algo( 'CRC32', lambda: RunningCksum(zlib.crc32), 4 )
+register_algo( 'ADLER32', lambda: RunningCksum(zlib.adler32), 4 )
+register_algo( 'BLAKE2B-64', lambda: hashlib.blake2b(digest_size=8), 8 )
+register_algo( 'BLAKE2B-128', lambda: hashlib.blake2b(digest_size=16), 16 )
+if( crc32c is not None ):
+	register_algo( 'CRC32C', lambda: RunningCksum(crc32c.crc32c), 4 )
+if( xxhash is not None ):
+	register_algo( 'XXH64', xxhash.xxh64, 8 )
+	register_algo( 'XXH3_64', xxhash.xxh3_64, 8 )
+	register_algo( 'XXH3_128', xxhash.xxh3_128, 16 )
+
+# returns a new hashlib-like object for the named algorithm
+# : raises ValueError for unknown names (like hashlib.new)
+def new_cksum( name ):
+	entry = algo_registry.get( name.upper() )
+	if( entry is not None ):
+		return entry[0]()
+	try:
+		return hashlib.new( name )
+	except ValueError:
+		# openssl doesn't care about case, but hashlib's built-ins do
+		return hashlib.new( name.lower() )
+
+def digest_size( name ):
+	entry = algo_registry.get( name.upper() )
+	if( entry is not None ):
+		return entry[1]
+	return new_cksum( name ).digest_size
+
+def is_known( name ):
+	try:
+		new_cksum( name )
+	except ValueError:
+		return False
+	return True
+
+# the registered algorithms plus the ones hashlib always has
+# : shake_* need a length for their digest, so they're no use here
+def list_algos():
+	names = list( algo_registry.keys() )
+	for name in sorted(hashlib.algorithms_guaranteed):
+		if( not name.startswith('shake_') ):
+			names.append( name.upper() )
+	return names
+
+# compact store for the per-disk cksums: one flat buffer of raw digests,
+# rather than a hex string per disk (a few bytes each instead of ~100)
+# : table[d] is disk d's (raw) digest
+class DigestTable:
+	__slots__ = ( 'count', 'nbytes', 'buf' )
+
+	def __init__( self, count, nbytes ):
+		self.count = count
+		self.nbytes = nbytes
+		self.buf = bytearray( count*nbytes )
+
+	def __len__( self ):
+		return self.count
+
+	def __getitem__( self, d ):
+		if( (d < 0) or (d >= self.count) ):
+			raise IndexError( "digest index out of range" )
+		st = d * self.nbytes
+		return bytes( self.buf[st:st+self.nbytes] )
+
+	def __setitem__( self, d, digest ):
+		if( (d < 0) or (d >= self.count) ):
+			raise IndexError( "digest index out of range" )
+		if( len(digest) != self.nbytes ):
+			raise ValueError( "digest is the wrong size" )
+		st = d * self.nbytes
+		self.buf[st:st+self.nbytes] = digest
+
+	def __iter__( self ):
+		for d in range(self.count):
+			yield self[d]
+
+	def __eq__( self, other ):
+		if( not isinstance(other,DigestTable) ):
+			return NotImplemented
+		return (self.nbytes == other.nbytes) and (self.buf == other.buf)
+
+	def hex( self, d ):
+		return self[d].hex()
+
+	# fill the whole table from raw digests (e.g. a .fr file's cksum section)
+	def load( self, dat ):
+		if( len(dat) != len(self.buf) ):
+			raise ValueError( "wrong number of digest bytes" )
+		self.buf[:] = dat
+		return 0
+
+	# list of disks whose digests differ from other's (plus any that other
+	# doesn't have at all) .. compares a chunk of digests at a time, so a
+	# run of matching digests costs a single memcmp
+	def mismatches( self, other, chunk=4096 ):
+		if( self.nbytes != other.nbytes ):
+			return list( range(self.count) )
+		nbytes = self.nbytes
+		n = min( self.count, other.count ) * nbytes
+		csize = chunk * nbytes
+
+		bad = []
+		for st in range(0,n,csize):
+			fn = min( st+csize, n )
+			if( self.buf[st:fn] == other.buf[st:fn] ):
+				continue
+			for ofs in range(st,fn,nbytes):
+				if( self.buf[ofs:ofs+nbytes] != other.buf[ofs:ofs+nbytes] ):
+					bad.append( ofs//nbytes )
+		bad.extend( range(min(self.count,other.count),self.count) )
+		return bad
+
+# cksum nbytes worth of block_size blocks with each algorithm, returns a
+# list of (name,digest_size,MB/s)
+def benchmark( names=None, nbytes=64*1024*1024, block_size=4096 ):
+	if( names is None ):
+		names = list_algos()
+	data = bytes( range(256) ) * (block_size//256 + 1)
+	blk = memoryview( data )[:block_size]
+	nblks = max( 1, nbytes//block_size )
+
+	rtn = []
+	for name in names:
+		t0 = time.perf_counter()
+		for b in range(nblks):
+			algo = new_cksum( name )
+			algo.update( blk )
+			algo.digest()
+		t1 = time.perf_counter()
+		rtn.append( (name, digest_size(name), nblks*block_size/(1024.0*1024.0)/max(t1-t0,1e-9)) )
+	return rtn
@@ -28,6 +28,8 @@ import string
 
 import utils
 import filerepair
+import cksums
+import statcache
 import logger
 
 def ParseCommandLineArguments():
@@ -45,10 +47,26 @@ def ParseCommandLineArguments():
 	parser.add_argument( '-i', action='count', help='use interleaved parity' )
 	parser.add_argument( '-r', action='count', help='use Reed-Solomon parity' )
 	parser.add_argument( '-X', action='count', help='use hypercube-raid system' )
+	parser.add_argument( '-f', '--fast', action='count', help='verify by checksums only (skip parity re-calculation)' )
+	parser.add_argument( '-t', nargs=1, type=int, help='number of threads for calculating checksums (default='+
+		str(rtn['hash_threads'])+')' )
+	parser.add_argument( '-n', nargs=1, type=int, help='number of processes to split big files over (default='+
+		str(rtn['num_procs'])+')' )
+	parser.add_argument( '-m', '--merkle', action='count', help='store a merkle tree over the checksums' )
+	parser.add_argument( '-s', action='count', help='stream the file one block at a time (constant memory)' )
+	parser.add_argument( '-a', '--append', action='count', help='update: assume the file has only been appended to' )
+	parser.add_argument( '--patch', action='count', help='repair: copy the file and re-write just the repaired blocks' )
+	parser.add_argument( '--inplace', action='count', help='repair: re-write just the repaired blocks of the original file' )
+	parser.add_argument( '--nocache', action='count', help='drop the file from the page cache as it is read' )
+	parser.add_argument( '--direct', action='count', help='read the file with O_DIRECT (bypass the page cache)' )
+	parser.add_argument( '-j', nargs=1, type=int, help='*all: number of files to work on at once (default='+
+		str(rtn['num_jobs'])+')' )
+	parser.add_argument( '--state', nargs=1, type=str, help='*all: remember file states in this file, skip unchanged files' )
+	parser.add_argument( '--reverify', nargs=1, type=float, help='*all: re-verify unchanged files after this many days' )
 	parser.add_argument( '-v', action='count', help='verbose output' )
 	parser.add_argument( '-V', action='count', help='really verbose output' )
-	parser.add_argument( 'command', nargs=1, help='command to execute (create, verify, repair)' )
-	parser.add_argument( 'filelist', nargs='+', help='file(s) to work with' )
+	parser.add_argument( 'command', nargs=1, help='command to execute (create, verify, repair, update, bench)' )
+	parser.add_argument( 'filelist', nargs='*', help='file(s) to work with' )
 
 	#
 	# parse the command-line arguments
@@ -75,9 +93,55 @@ def ParseCommandLineArguments():
 	elif( params['X'] != None ):
 		rtn['parity_type'] = 'x'
 
+	# read whole file into memory, or stream it?
+	if( params['s'] != None ):
+		rtn['streaming'] = True
+
+	# hash the blocks with multiple threads?
+	if( params['t'] != None ):
+		rtn['hash_threads'] = params['t'][0]
+
+	# split big files between several processes?
+	if( params['n'] != None ):
+		rtn['num_procs'] = params['n'][0]
+
+	# merkle tree over the cksums?
+	if( params['merkle'] != None ):
+		rtn['merkle'] = True
+
+	# fast (cksum-only) verify?
+	if( params['fast'] != None ):
+		rtn['fast_verify'] = True
+
+	# only look at the new blocks when updating?
+	if( params['append'] != None ):
+		rtn['append_only'] = True
+
+	# how to write out the repaired file
+	if( params['inplace'] != None ):
+		rtn['repair_mode'] = 'inplace'
+	elif( params['patch'] != None ):
+		rtn['repair_mode'] = 'patch'
+
+	# keep big scrubs out of the page cache?
+	if( params['direct'] != None ):
+		rtn['io_mode'] = 'direct'
+	elif( params['nocache'] != None ):
+		rtn['io_mode'] = 'nocache'
+
+	# work on several files at once?
+	if( params['j'] != None ):
+		rtn['num_jobs'] = params['j'][0]
+
+	# skip files that haven't changed since the last run?
+	if( params['state'] != None ):
+		rtn['state_db'] = params['state'][0]
+	if( params['reverify'] != None ):
+		rtn['reverify_days'] = params['reverify'][0]
+
 	# set cksum algorithm (if needed)
 	if( params['c'] != None ):
-		rtn['cksum_algo'] = string.upper(params['c'][0])
+		rtn['cksum_algo'] = params['c'][0].upper()
 
 	# make the code a bit more readable
 	if( params['v'] != None ):
@@ -98,6 +162,104 @@ def ParseCommandLineArguments():
 	return rtn
 
 
+# the '*all' commands .. these run in the worker processes (with -j), so
+# they have to be module-level functions; each task is (infile,status,st)
+# where status is from the state-db (statcache.NEW if there isn't one)
+def cmd_create( task, opts ):
+	infile = task[0]
+	chkfile = utils.calc_chk_filename( infile, opts )
+	err = filerepair.create_from_file( infile, chkfile, opts )
+	return err
+
+def cmd_verify( task, opts ):
+	infile = task[0]
+	chkfile = utils.calc_chk_filename( infile, opts )
+	err = filerepair.verify_file( infile, chkfile, opts )
+	return err
+
+def cmd_repair( task, opts ):
+	infile = task[0]
+	chkfile = utils.calc_chk_filename( infile, opts )
+	repfile = utils.calc_rep_filename( infile, opts )
+	err = filerepair.repair_file( infile, chkfile, repfile, opts )
+	return err
+
+def cmd_update( task, opts ):
+	(infile,status,st) = task
+	chkfile = utils.calc_chk_filename( infile, opts )
+	# if cksum file exists, then verify it (or, if we know the file
+	# has been written to since, update it)
+	if( utils.file_exists(chkfile) ):
+		if( status == statcache.CHANGED ):
+			err = filerepair.update_file( infile, chkfile, opts )
+		else:
+			err = filerepair.verify_file( infile, chkfile, opts )
+	# else create it
+	else:
+		err = filerepair.create_from_file( infile, chkfile, opts )
+	return err
+
+all_commands = {
+	'createall': cmd_create,
+	'verifyall': cmd_verify,
+	'repairall': cmd_repair,
+	'updateall': cmd_update
+}
+
+# walks the tree and hands the files out to the workers .. the state-db
+# is only touched here (in the parent), both to skip unchanged files and
+# to record the ones that were done ok
+def run_all( command, inpath, opts ):
+	cache = None
+	if( command != 'repairall' ):
+		cache = open_state_db( opts )
+	if( (cache != None) and (command == 'verifyall') and (float(opts['reverify_days']) <= 0) ):
+		logger.printLog( "* Warning: reverify_days is 0, unchanged files will never be re-verified" )
+	counts = { 'files':0, 'errors':0, 'skipped':0 }
+
+	def tasks():
+		for infile in utils.walk_files( inpath, opts ):
+			if( cache == None ):
+				yield (infile,statcache.NEW,None)
+				continue
+			(status,st) = cache.check( infile )
+			if( status == statcache.FRESH ):
+				if( (command == 'verifyall') or ((command == 'updateall')
+						and utils.file_exists(utils.calc_chk_filename(infile,opts))) ):
+					counts['skipped'] += 1
+					continue
+			yield (infile,status,st)
+
+	def done( task, err ):
+		counts['files'] += 1
+		if( err != 0 ):
+			counts['errors'] += 1
+			if( int(opts['num_jobs']) > 1 ):
+				logger.printLog( "* Error: %s returned %d"%(task[0],err) )
+		# only good runs count, so a damaged file is checked again
+		elif( cache != None ):
+			cache.record( task[0], task[2] )
+
+	err = utils.run_jobs( tasks(), all_commands[command], opts, int(opts['num_jobs']), done )
+	close_state_db( cache )
+
+	if( int(opts['verbose']) ):
+		logger.printLog( "%s: %d files, %d with errors, %d unchanged (skipped)"%(command,
+			counts['files'],counts['errors'],counts['skipped']) )
+
+	return err
+
+# the state-db is optional, so these return/accept None when there isn't one
+def open_state_db( opts ):
+	if( opts['state_db'] == '' ):
+		return None
+	return statcache.StatCache( opts['state_db'], opts['reverify_days'], opts['reverify_max'] )
+
+def close_state_db( cache ):
+	if( cache != None ):
+		cache.close()
+	return 0
+
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
@@ -116,7 +278,23 @@ def main():
 	err = -200
 	command = opts['command']
 
-	if( command == 'create' ):
+	if( (command != 'bench') and (len(opts['file_list']) == 0) ):
+		print( "* Error: no file(s) given" )
+		exit( -100 )
+
+	if( not cksums.is_known(opts['cksum_algo']) ):
+		print( "* Error: unknown cksum algorithm "+opts['cksum_algo']+" (known: "+", ".join(cksums.list_algos())+")" )
+		exit( -100 )
+
+	if( command == 'bench' ):
+		# how fast is each cksum algorithm on this machine?
+		block_size = int( opts['block_size'] )
+		logger.printLog( "cksum speeds for %d-byte blocks:"%(block_size) )
+		for (name,nbytes,mbps) in cksums.benchmark( block_size=block_size ):
+			logger.printLog( "  %-12s %3d bytes  %10.1f MB/s"%(name,nbytes,mbps) )
+		err = 0
+
+	elif( command == 'create' ):
 		# create cksum-data for a file
 		infile = opts['file_list'][0]
 		chkfile = utils.calc_chk_filename( infile, opts )
@@ -144,55 +322,19 @@ def main():
 			repfile = utils.calc_rep_filename( infile, opts )
 		err = filerepair.repair_file( infile, chkfile, repfile, opts )
 
-	elif( command == 'createall' ):
-		# create cksum-data for all files in dir (per opts file)
-		utils.go_nice( opts )
-		inpath = opts['file_list'][0]
-		def cmd_create( infile, _opts ):
-			chkfile = utils.calc_chk_filename( infile, _opts )
-			err = filerepair.create_from_file( infile, chkfile, _opts )
-			return err
-
-		err = utils.walk_directory_tree( inpath, opts, cmd_create )
-
-	elif( command == 'verifyall' ):
-		# verify all files in a dir (per opts file)
-		utils.go_nice( opts )
-		inpath = opts['file_list'][0]
-		def cmd_verify( infile, _opts ):
-			chkfile = utils.calc_chk_filename( infile, _opts )
-			err = filerepair.verify_file( infile, chkfile, _opts )
-			return err
-
-		err = utils.walk_directory_tree( inpath, opts, cmd_verify )
-
-	elif( command == 'repairall' ):
-		# repair all files in a dir (per opts file)
-		utils.go_nice( opts )
-		inpath = opts['file_list'][0]
-		def cmd_repair( infile, _opts ):
-			chkfile = utils.calc_chk_filename( infile, _opts )
-			repfile = utils.calc_rep_filename( infile, _opts )
-			err = filerepair.repair_file( infile, chkfile, repfile, _opts )
-			return err
-
-		err = utils.walk_directory_tree( inpath, opts, cmd_repair )
+	elif( command == 'update' ):
+		# bring the cksum-data up to date with a changed file
+		infile = opts['file_list'][0]
+		if( len(opts['file_list']) >= 2 ):
+			chkfile = opts['file_list'][1]
+		else:
+			chkfile = utils.calc_chk_filename( infile, opts )
+		err = filerepair.update_file( infile, chkfile, opts )
 
-	elif( command == 'updateall' ):
-		# create or verify all files in a dir (per opts file)
+	elif( command in all_commands ):
+		# act on all files in dir (per opts file)
 		utils.go_nice( opts )
-		inpath = opts['file_list'][0]
-		def cmd_update( infile, _opts ):
-			chkfile = utils.calc_chk_filename( infile, _opts )
-			# if cksum file exists, then verify it
-			if( file_exists(chkfile) ):
-				err = filerepair.verify_file( infile, chkfile, _opts )
-			# else create it
-			else:
-				err = filerepair.create_from_file( infile, chkfile, _opts )
-			return err
-
-		err = utils.walk_directory_tree( inpath, opts, cmd_update )
+		err = run_all( command, opts['file_list'][0], opts )
 
 	else:
 		# shouldn't be able to get here!
@@ -35,6 +35,17 @@ import logger
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
+# overwrite raid opts with what we found in the parity-file .. on a copy,
+# so they don't leak into the next file of an '*all' run
+def layout_opts( opts, parity_obj ):
+	opts = dict( opts )
+	opts['num_parity_disks'] = parity_obj.num_parity_disks
+	opts['block_size']       = parity_obj.block_size
+	opts['cksum_algo']       = parity_obj.cksum_algo
+	opts['parity_type']      = parity_obj.parity_type
+	opts['stripe_size']      = parity_obj.stripe_size
+	return opts
+
 def repair_file( infile, chkfile, repfile, opts=None ):
 	if( opts == None ):
 		opts = utils.DefaultOpts()
@@ -59,10 +70,7 @@ def repair_file( infile, chkfile, repfile, opts=None ):
 	# NOTE: we'll assume that the cksum file has not been
 	#       corrupted, or at least that the opts below
 	#       are still intact
-	opts['num_parity_disks'] = parity_obj.num_parity_disks
-	opts['block_size']       = parity_obj.block_size
-	opts['cksum_algo']       = parity_obj.cksum_algo
-	opts['parity_type']      = parity_obj.parity_type
+	opts = layout_opts( opts, parity_obj )
 
 	# check if file-size has changed
 	if( file_size != parity_obj.file_size ):
@@ -71,27 +79,87 @@ def repair_file( infile, chkfile, repfile, opts=None ):
 		file_size = parity_obj.file_size
 
 	data_obj = repairObj.RepairObj( file_size, opts )
-	err = data_obj.read_file( infile )
-	if( err ):
-		logger.printLog( "* Error: cannot read file contents" )
-		return -2
+
+	streaming = utils.convert_from_tfyn( opts['streaming'] )
+	if( streaming and not data_obj.can_stream() ):
+		if( verbose ):
+			logger.printLog( "parity type %s cannot be streamed, reading whole file"%(data_obj.parity_type) )
+		streaming = False
 
 	# re-calculate the raid/cksum stuff for the file itself
-	data_obj.calc_parity()
-	data_obj.calc_cksums()
+	# : when streaming (or splitting a big file between processes), that is
+	#   done first, and then only the bad blocks are read back in
+	segmented = data_obj.can_segment()
+	if( streaming or segmented ):
+		if( segmented ):
+			err = data_obj.calc_segments( infile )
+		else:
+			err = data_obj.stream_file( infile )
+		if( err ):
+			logger.printLog( "* Error: cannot read file contents" )
+			return -2
+		# : hypercube parity finds the damage from the parity itself
+		disk_errors = []
+		if( data_obj.uses_cksums ):
+			disk_errors = data_obj.find_bad_disks( parity_obj )
+			if( disk_errors is None ):
+				logger.printLog( "* Error: cannot read cksums from raid/cksum file="+chkfile )
+				return -3
+			if( len(disk_errors) == 0 ):
+				# a healthy file isn't touched again
+				if( verbose ):
+					logger.printLog( "No errors detected in file, nothing to repair" )
+				return 0
+		try:
+			err = data_obj.calc_repair_streamed( parity_obj, infile, disk_errors )
+		except IOError as e:
+			logger.printLog( "* Error: cannot read file contents: "+str(e) )
+			return -2
+		if( (err == 0) and (len(data_obj.repaired_blocks) == 0) ):
+			if( verbose ):
+				logger.printLog( "No errors detected in file, nothing to repair" )
+			return 0
+	else:
+		err = data_obj.read_file( infile )
+		if( err ):
+			logger.printLog( "* Error: cannot read file contents" )
+			return -2
+		data_obj.calc_parity()
+		if( data_obj.uses_cksums ):
+			data_obj.calc_cksums()
 
-	# TODO: should include cksum comparison for parity disks too
+		# TODO: should include cksum comparison for parity disks too
 
-	# do the repair in-place
-	err = data_obj.calc_repair( parity_obj )
+		# do the repair in-place
+		err = data_obj.calc_repair( parity_obj )
 	if( err ):
 		logger.printLog( "* Error: problem with file reconstruction" )
 		return -3
 
-	# TODO: double-check that the correction worked!
+	# double-check that the correction worked .. if the .fr file itself is
+	# damaged, a block can be "repaired" into the wrong data
+	bad_blocks = data_obj.check_repaired( parity_obj )
+	if( len(bad_blocks) > 0 ):
+		logger.printLog( "* Error: repaired blocks do not match their cksums (%s), not writing the repair"%(
+			",".join([ str(d) for d in bad_blocks ])) )
+		return -4
 
-	# TODO: this may make a copy of the file's data
-	err = data_obj.write_file( repfile )
+	if( verbose > 2 ):
+		logger.printLog( "repaired %d blocks"%(len(data_obj.repaired_blocks)) )
+
+	# only the repaired blocks need to be written, unless asked for a
+	# whole new copy of the file
+	repair_mode = opts['repair_mode']
+	if( (repair_mode == 'inplace') and (file_size != os.path.getsize(infile)) ):
+		logger.printLog( "* Error: cannot repair in-place when file-size has changed, writing "+repfile )
+		repair_mode = 'patch'
+
+	if( repair_mode == 'inplace' ):
+		err = data_obj.write_blocks( infile, parity_obj )
+	elif( repair_mode == 'patch' ):
+		err = data_obj.write_file_patched( infile, repfile, parity_obj )
+	else:
+		err = data_obj.write_file( repfile )
 	if( err > 0 ):
 		logger.printLog( "* Error: could not write repaired file" )
 		return err
@@ -120,39 +188,116 @@ def verify_file( infile, chkfile, opts=None ):
 		logger.printLog( "* Error: cannot read raid/cksum file="+chkfile )
 		return -2
 
-	# overwrite raid opts with what we found in the parity-file
-	opts['num_parity_disks'] = parity_obj.num_parity_disks
-	opts['block_size']       = parity_obj.block_size
-	opts['cksum_algo']       = parity_obj.cksum_algo
-	opts['parity_type']      = parity_obj.parity_type
+	opts = layout_opts( opts, parity_obj )
 
 	# check if file-size has changed
 	if( file_size != parity_obj.file_size ):
-		logger.printLog( '* Error: file-size has changed (%d,%d)'%(file_size,parity_obj.file_size) )
+		logger.printLog( '* Error: file-size has changed (%d,%d), use update to re-protect it'%(file_size,parity_obj.file_size) )
+
+	# fast mode only compares cksums, but they have to cover the whole file
+	# (and the same file) for that to be trusted .. else check parity too
+	# : hypercube parity has no per-block cksums at all
+	fast = utils.convert_from_tfyn( opts['fast_verify'] )
+	if( fast ):
+		if( (file_size != parity_obj.file_size) or (not parity_obj.uses_cksums)
+				or ((parity_obj.num_data_disks*parity_obj.block_size) < file_size) ):
+			if( verbose ):
+				logger.printLog( "cksums alone are not conclusive, checking parity too" )
+			fast = False
 
 	# now we can read the original file
 	data_obj = repairObj.RepairObj( file_size, opts )
-	err = data_obj.read_file( infile )
-	if( err ):
-		logger.printLog( "* Error: cannot read file contents" )
-		return -3
 
-	# re-calculate the raid/cksum stuff for the file itself
-	data_obj.calc_parity()
-	data_obj.calc_cksums()
+	streaming = utils.convert_from_tfyn( opts['streaming'] )
+	if( streaming and not fast and not data_obj.can_stream() ):
+		if( verbose ):
+			logger.printLog( "parity type %s cannot be streamed, reading whole file"%(data_obj.parity_type) )
+		streaming = False
+
+	# big files get split between num_procs processes
+	segmented = data_obj.can_segment()
+
+	if( streaming and not segmented ):
+		# cksums are compared as each block is read, so errors get
+		# reported as soon as they are found
+		bad_disks = []
+		def report_disk( d ):
+			logger.printLog( "* Error: cksum on disk %d does not match"%(d) )
+			bad_disks.append( d )
+
+		# : with a merkle tree, it's cheaper to compare everything at the
+		#   end (only the mis-matched parts of the tree need to be read)
+		use_tree = parity_obj.has_merkle and (data_obj.num_data_disks == parity_obj.num_data_disks)
+		if( data_obj.uses_cksums and not use_tree ):
+			if( parity_obj.load_cksums() != 0 ):
+				logger.printLog( "* Error: cannot read cksums from raid/cksum file="+chkfile )
+				return -2
+			check_obj = parity_obj
+		else:
+			check_obj = None
+		err = data_obj.stream_file( infile, check_obj, report_disk, not fast )
+		if( err ):
+			logger.printLog( "* Error: cannot read file contents" )
+			return -3
+		if( data_obj.uses_cksums and use_tree ):
+			tree_disks = data_obj.find_bad_disks( parity_obj )
+			if( tree_disks is None ):
+				logger.printLog( "* Error: cannot read cksums from raid/cksum file="+chkfile )
+				return -2
+			for d in tree_disks:
+				report_disk( d )
+		err = len( bad_disks )
+
+	else:
+		if( segmented ):
+			err = data_obj.calc_segments( infile, not fast )
+		else:
+			err = data_obj.read_file( infile )
+		if( err ):
+			logger.printLog( "* Error: cannot read file contents" )
+			return -3
 
-	# go through each disk and compare cksums
-	for d in range(data_obj.num_data_disks):
-		if( verbose > 9 ):
-			logger.printLog( "digests for d=%d are %s and %s"%(d,data_obj.disk_cksums[d],parity_obj.disk_cksums[d]) )
+		# re-calculate the raid/cksum stuff for the file itself
+		if( (not fast) and (not segmented) ):
+			data_obj.calc_parity()
+		if( data_obj.uses_cksums ):
+			if( not segmented ):
+				data_obj.calc_cksums()
+			bad_disks = data_obj.find_bad_disks( parity_obj )
+			if( bad_disks is None ):
+				logger.printLog( "* Error: cannot read cksums from raid/cksum file="+chkfile )
+				return -2
+		else:
+			bad_disks = []
+
+		# go through each bad disk
+		for d in bad_disks:
+			if( d >= parity_obj.num_data_disks ):
+				if( verbose ):
+					logger.printLog( "* Error: no cksum for disk %d"%(d) )
+				err += 1
+				continue
+
+			if( verbose > 9 ):
+				logger.printLog( "digests for d=%d are %s and %s"%(d,data_obj.disk_cksums.hex(d),parity_obj.merkle_node(0,d).hex()) )
 
-		if( data_obj.disk_cksums[d] != parity_obj.disk_cksums[d] ):
 			if( verbose ):
 				logger.printLog( "* Error: cksum on disk %d does not match"%(d) )
 			err += 1
 
-	# now check parity
-	for p in range(data_obj.num_parity_disks):
+	# now check parity (only now do we need it from the raid/cksum file)
+	if( not fast ):
+		if( parity_obj.load_parity() != 0 ):
+			logger.printLog( "* Error: cannot read parity from raid/cksum file="+chkfile )
+			return -2
+	for p in range(data_obj.num_parity_blocks):
+		if( fast ):
+			break
+		if( p >= parity_obj.num_parity_blocks ):
+			err += 1
+			continue
+		if( data_obj.parity_data[p] == parity_obj.parity_data[p] ):
+			continue
 		for i in range(data_obj.block_size):
 			if( data_obj.parity_data[p][i] != parity_obj.parity_data[p][i] ):
 				if( verbose ):
@@ -170,6 +315,82 @@ def verify_file( infile, chkfile, opts=None ):
 	logger.printLog( "Found %d errors in file"%(err) )
 	return -1
 
+# brings an existing raid/cksum file up to date with a file that has been
+# modified or appended to, re-using the old cksums and parity wherever the
+# file hasn't changed (falls back to a full create where it can't)
+def update_file( infile, chkfile, opts=None ):
+	if( opts == None ):
+		opts = utils.DefaultOpts()
+
+	verbose = int(opts['verbose'])
+
+	if( verbose ):
+		logger.printLog( "updating raid+cksum data for file="+infile+" ("+chkfile+")" )
+
+	try:
+		file_size = os.path.getsize( infile )
+	except:
+		logger.printLog( "* Error: cannot open file="+infile )
+		return -1
+
+	parity_obj = repairObj.RepairObj( file_size, opts )
+	err = parity_obj.read_parityfile( chkfile )
+	if( err ):
+		logger.printLog( "* Error: cannot read raid/cksum file="+chkfile )
+		return -2
+
+	# keep the layout (and format) of the old raid/cksum file, except that
+	# a lone stripe is free to grow along with the file
+	layout = layout_opts( opts, parity_obj )
+	if( parity_obj.num_stripes <= 1 ):
+		layout['stripe_size'] = opts['stripe_size']
+	opts = layout
+	opts['merkle'] = parity_obj.has_merkle
+	if( (parity_obj.parity_source is not None) and (parity_obj.parity_source[0] == 'text') ):
+		opts['fr_format'] = 'text'
+
+	append_only = utils.convert_from_tfyn( opts['append_only'] )
+	if( append_only and (file_size == parity_obj.file_size) ):
+		if( verbose ):
+			logger.printLog( "file-size has not changed, nothing to update" )
+		return 0
+
+	# with --append, only the old last block and the new data are needed,
+	# so just those get read (the rest could be most of a big file)
+	data_obj = repairObj.RepairObj( file_size, opts )
+	if( append_only ):
+		err = data_obj.open_blocks( infile )
+	else:
+		err = data_obj.read_file( infile )
+	if( err ):
+		logger.printLog( "* Error: cannot read file contents" )
+		return -3
+
+	try:
+		err = data_obj.calc_update( parity_obj, append_only )
+	except IOError as e:
+		logger.printLog( "* Error: cannot read file contents: "+str(e) )
+		return -3
+	if( append_only and (verbose > 2) ):
+		logger.printLog( "read %d blocks to update the file"%(len(data_obj.blocks_read)) )
+	if( err > 0 ):
+		if( verbose ):
+			logger.printLog( "cannot update this raid/cksum file in place, re-creating it" )
+		return create_from_file( infile, chkfile, opts )
+	if( err < 0 ):
+		logger.printLog( "* Error: cannot read raid/cksum file="+chkfile )
+		return -2
+
+	# don't clobber the old file until the new one is all there
+	tmpfile = chkfile + '.tmp'
+	err = data_obj.write_parityfile( tmpfile )
+	if( err ):
+		logger.printLog( "* Error: cannot write output cksum file="+chkfile )
+		return -4
+	os.replace( tmpfile, chkfile )
+
+	return 0
+
 def create_from_file( infile, chkfile, opts=None ):
 	if( opts == None ):
 		opts = utils.DefaultOpts()
@@ -187,7 +408,22 @@ def create_from_file( infile, chkfile, opts=None ):
 
 	repair_obj = repairObj.RepairObj( file_size, opts )
 
-	err = repair_obj.read_file( infile )
+	streaming = utils.convert_from_tfyn( opts['streaming'] )
+	if( streaming and not repair_obj.can_stream() ):
+		if( verbose ):
+			logger.printLog( "parity type %s cannot be streamed, reading whole file"%(repair_obj.parity_type) )
+		streaming = False
+
+	# big files get split between num_procs processes
+	segmented = repair_obj.can_segment()
+
+	if( segmented ):
+		err = repair_obj.calc_segments( infile )
+	elif( streaming ):
+		# cksums and parity are calculated while the file is read
+		err = repair_obj.stream_file( infile )
+	else:
+		err = repair_obj.read_file( infile )
 	if( err ):
 		logger.printLog( "* Error: cannot read file contents" )
 		return -2
@@ -196,12 +432,18 @@ def create_from_file( infile, chkfile, opts=None ):
 		logger.printLog( "found %d bytes of data"%(repair_obj.file_size) )
 		logger.printLog( "parity type = %s"%(repair_obj.parity_type) )
 		logger.printLog( "num parity disks = %d"%(repair_obj.num_parity_disks) )
+		logger.printLog( "num stripes = %d"%(repair_obj.num_stripes) )
 		logger.printLog( "block size = %d"%(repair_obj.block_size) )
-		logger.printLog( "cksum algorithm = %s"%(repair_obj.cksum_algo) )
+		logger.printLog( "cksum algorithm = %s (%d bytes)"%(repair_obj.cksum_algo,repair_obj.bytes_per_cksum) )
+		overhead = repair_obj.calc_overhead()
+		logger.printLog( "overhead = %d bytes (%.2f%%)"%(overhead,100.0*overhead/max(1,repair_obj.file_size)) )
 		logger.printLog( "estim memory used = %d"%(repair_obj.memory_used) )
+		if( segmented ):
+			logger.printLog( "split into %d-byte segments over %d processes"%(repair_obj.segment_size,repair_obj.num_procs) )
 
-	repair_obj.calc_parity()
-	repair_obj.calc_cksums()
+	if( not (streaming or segmented) ):
+		repair_obj.calc_parity()
+		repair_obj.calc_cksums()
 
 	if( chkfile is not None ):
 		err = repair_obj.write_parityfile( chkfile )
@@ -214,6 +456,7 @@ def create_from_file( infile, chkfile, opts=None ):
 			'parity_type': repair_obj.parity_type,
 			'num_data_disks': repair_obj.num_data_disks,
 			'num_parity_disks': repair_obj.num_parity_disks,
+			'stripe_size': repair_obj.stripe_size,
 			'block_size': repair_obj.block_size,
 			'file_size': repair_obj.file_size,
 			'cksum_algo': repair_obj.cksum_algo,
@@ -221,10 +464,10 @@ def create_from_file( infile, chkfile, opts=None ):
 			'parity_data': []
 		}
 
-		for dat in repair_obj.disk_cksums:
-			rtn['disk_cksums'].append( dat )
+		for d in range(repair_obj.num_data_disks):
+			rtn['disk_cksums'].append( repair_obj.disk_cksums.hex(d) )
 
-		for p in range(repair_obj.num_parity_disks):
+		for p in range(repair_obj.num_parity_blocks):
 			dat = binascii.hexlify( repair_obj.parity_data[p] )
 			rtn['parity_data'].append( dat.decode(encoding='utf-8',errors='strict') )
 		
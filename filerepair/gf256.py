@@ -0,0 +1,224 @@
+#!/usr/bin/python
+#
+# (C) 2015-2016, John Pormann, Duke University, jbp1@duke.edu
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#	The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# block-wide GF(256) arithmetic for the Reed-Solomon parity calcs
+#
+# systematic RS encoding is linear over GF(256), so each parity symbol is
+# just a weighted sum of the data symbols in that column:
+#     parity[p][i] = sum_d P[p][d] * data[d][i]
+# with the weights P[p][d] coming from the generator polynomial.  Since the
+# weights are the same for every column i, we can do a whole block (all
+# columns) at once: multiplying a block by a constant is a 256-entry table
+# lookup (bytes.translate) and adding blocks together is an XOR
+
+#
+# everything that only depends on the field and code parameters (log/exp
+# tables, multiplication tables, generator polynomial, parity weights) is
+# built once per process and kept in a registry, keyed on
+# (prim, generator, c_exp, fcr, nsym) .. none of it touches the module
+# globals in reedsolo, so it is safe to share between threads
+
+import threading
+
+import reedsolo
+import xorengine
+
+codec_registry = {}
+registry_lock = threading.Lock()
+
+# returns the (cached) codec info for a given RS code
+def get_codec( nsym, prim=0x11d, generator=2, c_exp=8, fcr=0 ):
+	key = (prim,generator,c_exp,fcr,nsym)
+	codec = codec_registry.get( key )
+	if( codec is not None ):
+		return codec
+
+	with registry_lock:
+		# someone else may have beaten us to it
+		codec = codec_registry.get( key )
+		if( codec is None ):
+			codec = make_codec( nsym, prim, generator, c_exp, fcr )
+			codec_registry[key] = codec
+	return codec
+
+def make_codec( nsym, prim, generator, c_exp, fcr ):
+	field = get_field( prim, generator, c_exp )
+	gf_exp = field['gf_exp']
+	gf_log = field['gf_log']
+	field_charac = field['field_charac']
+
+	# generator poly = prod_i (x - generator^(i+fcr)), highest-degree first
+	gen = bytearray( [1] )
+	for i in range(nsym):
+		root = gf_exp[ (gf_log[generator]*(i+fcr)) % field_charac ]
+		nxt = bytearray( len(gen)+1 )
+		for j in range(len(gen)):
+			nxt[j] ^= gen[j]
+			nxt[j+1] ^= gf_mul( field, gen[j], root )
+		gen = nxt
+
+	codec = {
+		'nsym': nsym,
+		'fcr': fcr,
+		'field': field,
+		'mul_tables': field['mul_tables'],
+		'gen': bytes( gen ),
+		'lgen': bytes( [ gf_log[g] for g in gen ] ),
+		# parity weights, by number of data symbols
+		'pmatrix': {},
+		'lock': threading.Lock()
+	}
+	return codec
+
+field_registry = {}
+
+# log/exp tables and the per-constant multiplication tables for the field;
+# mul_tables[c][x] = c*x, for use with bytes.translate
+def get_field( prim, generator, c_exp ):
+	key = (prim,generator,c_exp)
+	field = field_registry.get( key )
+	if( field is not None ):
+		return field
+
+	field_charac = int( 2**c_exp - 1 )
+	gf_exp = bytearray( field_charac*2 )
+	gf_log = bytearray( field_charac+1 )
+	x = 1
+	for i in range(field_charac):
+		gf_exp[i] = x
+		gf_log[x] = i
+		x = reedsolo.gf_mult_noLUT( x, generator, prim, field_charac+1 )
+	for i in range(field_charac,field_charac*2):
+		gf_exp[i] = gf_exp[i-field_charac]
+
+	mul_tables = [ bytes(field_charac+1) ]
+	for c in range(1,field_charac+1):
+		lc = gf_log[c]
+		tbl = bytearray( field_charac+1 )
+		for x in range(1,field_charac+1):
+			tbl[x] = gf_exp[ lc + gf_log[x] ]
+		mul_tables.append( bytes(tbl) )
+
+	field = {
+		'field_charac': field_charac,
+		'gf_exp': bytes( gf_exp ),
+		'gf_log': bytes( gf_log ),
+		'mul_tables': mul_tables
+	}
+	field_registry[key] = field
+	return field
+
+def gf_mul( field, x, y ):
+	if( (x == 0) or (y == 0) ):
+		return 0
+	return field['gf_exp'][ field['gf_log'][x] + field['gf_log'][y] ]
+
+def gf_inverse( field, x ):
+	return field['gf_exp'][ field['field_charac'] - field['gf_log'][x] ]
+
+# P[p][d] = weight of data-symbol d in parity-symbol p, for a message of
+# num_data symbols (same layout as rs_encode_msg)
+# : data-symbol d is the coefficient of x^(num_data-1-d), so its parity is
+#   the remainder of x^(num_data-1-d+nsym) mod gen
+def parity_matrix( codec, num_data ):
+	pmatrix = codec['pmatrix'].get( num_data )
+	if( pmatrix is not None ):
+		return pmatrix
+
+	with codec['lock']:
+		pmatrix = codec['pmatrix'].get( num_data )
+		if( pmatrix is None ):
+			pmatrix = make_parity_matrix( codec, num_data )
+			codec['pmatrix'][num_data] = pmatrix
+	return pmatrix
+
+def make_parity_matrix( codec, num_data ):
+	field = codec['field']
+	nsym = codec['nsym']
+	gen = codec['gen']
+	if( (num_data+nsym) > field['field_charac'] ):
+		raise ValueError( "Message is too long (%i when max is %i)"%(num_data+nsym,field['field_charac']) )
+
+	# remainders, highest-degree first; x^nsym mod gen is just the
+	# lower terms of the (monic) generator
+	rems = [ None for d in range(num_data) ]
+	r = bytearray( gen[1:] )
+	for d in range(num_data-1,-1,-1):
+		rems[d] = r
+		# multiply by x, then reduce
+		c = r[0]
+		r = r[1:] + bytearray(1)
+		if( c != 0 ):
+			for j in range(nsym):
+				r[j] ^= gf_mul( field, c, gen[j+1] )
+
+	pmatrix = []
+	for p in range(nsym):
+		pmatrix.append( bytes( [ rems[d][p] for d in range(num_data) ] ) )
+	return tuple( pmatrix )
+
+# adds coef*blk into a running accumulator (see xorengine.new_acc)
+def acc_muladd( acc, coef, blk, mul_tables, engine='int' ):
+	if( coef == 0 ):
+		return acc
+	if( coef != 1 ):
+		blk = bytes(blk).translate( mul_tables[coef] )
+	return xorengine.acc_xor( acc, blk, engine )
+
+# invert a square matrix over GF(256) with Gauss-Jordan elimination
+# : returns None if the matrix is singular
+def invert_matrix( field, amat ):
+	n = len( amat )
+	a = [ bytearray(row) for row in amat ]
+	inv = [ bytearray(n) for i in range(n) ]
+	for i in range(n):
+		inv[i][i] = 1
+
+	for col in range(n):
+		# find a pivot
+		piv = -1
+		for row in range(col,n):
+			if( a[row][col] != 0 ):
+				piv = row
+				break
+		if( piv < 0 ):
+			return None
+		a[col], a[piv] = a[piv], a[col]
+		inv[col], inv[piv] = inv[piv], inv[col]
+
+		# scale the pivot row so the pivot is 1
+		scale = gf_inverse( field, a[col][col] )
+		for j in range(n):
+			a[col][j] = gf_mul( field, a[col][j], scale )
+			inv[col][j] = gf_mul( field, inv[col][j], scale )
+
+		# and clear that column from every other row
+		for row in range(n):
+			c = a[row][col]
+			if( (row == col) or (c == 0) ):
+				continue
+			for j in range(n):
+				a[row][j] ^= gf_mul( field, c, a[col][j] )
+				inv[row][j] ^= gf_mul( field, c, inv[col][j] )
+
+	return inv
@@ -21,6 +21,7 @@
 # SOFTWARE.
 #
 
+import sys
 import time
 
 logToFile = False
@@ -55,6 +56,10 @@ def printLog( message ):
 	tstamp = time.strftime( "%Y-%m-%d %H:%M:%S | " )
 	if( logToFile ):
 		logFilePointer.write( tstamp+message+"\n" )
+		# the '*all' commands may be logging from several processes, so
+		# don't let whole lines sit in (or get split across) buffers
+		logFilePointer.flush()
 	else:
-		print( tstamp+message )
+		sys.stdout.write( tstamp+message+"\n" )
+		sys.stdout.flush()
 
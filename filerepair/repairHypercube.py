@@ -24,7 +24,7 @@
 # this code is an attempt at using XOR/RAID-4/-5 techniques on a file, to
 # provide better repair-ability in the event of unrecoverable hardware errors
 
-import utils
+import xorengine
 
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
@@ -32,81 +32,131 @@ import utils
 
 
 # calculate parity "drives" based on hypercube-coords for each block
+# : parity-disks 2*j and 2*j+1 hold the XOR of all blocks whose index has
+#   bit j clear or set (respectively)
 def calc_parity( obj ):
 	num_parity_disks = obj.num_parity_disks
 	block_size = obj.block_size
-	file_size  = obj.file_size
+	num_blocks = obj.num_blocks
+	num_bits = num_parity_disks // 2
 
 	# ref to data matrices
 	data = obj.data
 	parity = obj.parity_data
 
-	# how many blocks?
-	num_blocks = math.ceil( file_size / block_size )
-	num_bits = math.ceil( math.log2(num_blocks) )
-
-	# TODO: this may already have been zero'd out
+	planes = xorengine.xor_bitplanes( data, num_blocks, block_size, num_bits, obj.xor_engine )
 	for p in range(num_parity_disks):
-		parity[p] = bytearray( block_size )
-
-	# go through each block
-	for b in range(num_blocks):
-		# calculate block coords
-		coords = utils.to_binarray( b, num_bits )
+		parity[p] = planes[p]
 
-		# st/fn are the start/finish points for this block of data
-		st = b * block_size
+	return 0
 
-		# for each bit in the block-coord, add it in to that parity-disk's calculations
-		ofs = 0
-		for j in range(num_bits-1,-1,-1):
-			p = ofs + coords[j]
-			for i in range(block_size):
-				parity[p][i] ^= data[st+i]
-			ofs = ofs + 2
+# streaming versions of calc_parity .. we keep the XOR of all blocks plus
+# the "bit set" half of each plane, and fill in the other half at the end
+def start_parity( obj ):
+	num_bits = obj.num_parity_disks // 2
+	state = {
+		'total': xorengine.new_acc( obj.block_size, obj.xor_engine ),
+		'ones': [ xorengine.new_acc(obj.block_size,obj.xor_engine) for j in range(num_bits) ]
+	}
+	return state
+
+def add_block( obj, state, d, blk ):
+	engine = obj.xor_engine
+	state['total'] = xorengine.acc_xor( state['total'], blk, engine )
+	ones = state['ones']
+	j = 0
+	while( d ):
+		if( d & 1 ):
+			ones[j] = xorengine.acc_xor( ones[j], blk, engine )
+		d >>= 1
+		j += 1
+	return 0
 
+def finish_parity( obj, state ):
+	block_size = obj.block_size
+	engine = obj.xor_engine
+	total = xorengine.acc_bytes( state['total'], block_size, engine )
+	for j in range(obj.num_parity_disks//2):
+		ones = xorengine.acc_bytes( state['ones'][j], block_size, engine )
+		obj.parity_data[2*j] = xorengine.xor_bytes( total, ones, engine )
+		obj.parity_data[2*j+1] = ones
 	return 0
 
+# with hypercube parity we don't need per-block cksums to find the damage:
+# a single damaged block b shows up in exactly one plane of every pair
+# (plane 2*j+bit_j(b)), and each of those planes is off by the same amount,
+# so the mismatch pattern spells out b's index and the delta repairs it
+# : disk_errors is ignored, and data_obj must already have its parity
+#   re-calculated (i.e. calc_parity has been run on the damaged data)
 def repair_errors( data_obj, disk_errors, parity_obj ):
-	# some heavily used values
-	num_data_disks = data_obj.num_data_disks
-	num_parity_disks = data_obj.num_parity_disks
-	block_size = data_obj.block_size
-	data = data_obj.data
-	parity_data = parity_obj.parity_data
-
-	n = len(disk_errors)
-	if( n == 0 ):
-		# no errors found .. shouldn't really occur
+	engine = data_obj.xor_engine
+
+	if( parity_obj.load_parity() != 0 ):
+		return -1
+	(bad_blk,delta) = find_damage( data_obj, parity_obj )
+	if( bad_blk == -1 ):
+		# no damage found (or only the parity-file was damaged)
 		return 0
-	if( n > num_parity_disks ):
-		#print "* Error: more than 2 disk errors with RAID-4I .. cannot repair file"
+	if( bad_blk < 0 ):
+		# more than one damaged block .. cannot repair file
 		return -1
 
-	for ctr in range(n):
-		# : what disk is in error?
-		d1 = disk_errors[ ctr ]
-		# : which parity-interleave-group is in error?
-		pgrp1 = d1 % num_parity_disks
-
-		#print "repairing virtual disk",d1,"from parity data ( disk",p_disk,")"
-
-		# first, we'll fold in the parity data
-		st1 = d1 * block_size
-		for i in range(block_size):
-			data[st1+i] = parity_data[pgrp1][i]
-
-		# now, go thru the rest of the virtual-disks
-		for d2 in range(num_data_disks):
-			pgrp2 = d2 % num_parity_disks
-			if( (d1!=d2) and (pgrp1==pgrp2) ):
-				#print( "  folding in d="+str(d2)+" ("+str(pgrp2)+")" )
-				st2 = d2 * block_size
-				for i in range(block_size):
-					data[st1+i] ^= data[st2+i]
-
-		#ctr += 1
-		#if( ctr == len(disk_errors) ):
-		#	break
+	data_obj.set_block( bad_blk, xorengine.xor_bytes(data_obj.get_block(bad_blk),delta,engine) )
 
 	return 0
+
+# compares the re-calculated parity against the stored parity, returns:
+#   (b,delta) if block b is damaged (block ^ delta is the original data)
+#   (-1,None) if the data is fine
+#   (-2,None) if more than one block is damaged, or it can't tell which
+def find_damage( data_obj, parity_obj ):
+	num_bits = data_obj.num_parity_disks // 2
+	engine = data_obj.xor_engine
+	new_parity = data_obj.parity_data
+	old_parity = parity_obj.parity_data
+
+	diffs = []
+	for p in range(2*num_bits):
+		if( new_parity[p] == old_parity[p] ):
+			diffs.append( None )
+		else:
+			diffs.append( xorengine.xor_bytes(new_parity[p],old_parity[p],engine) )
+
+	nbad = len( diffs ) - diffs.count( None )
+	if( nbad == 0 ):
+		return (-1,None)
+	if( (nbad == 1) and (num_bits > 1) ):
+		# one lone bad plane means the parity-file itself was damaged
+		return (-1,None)
+	if( nbad == 1 ):
+		# with only one pair of planes, a damaged block and a damaged plane
+		# in the parity-file look the same .. block 0's cksum can tell them
+		# apart for block 0, but for block 1 we can't tell, so don't guess
+		if( (diffs[0] is None) or (parity_obj.num_data_disks < 1) ):
+			return (-2,None)
+		if( data_obj.calc_one_cksum(data_obj.get_block(0)) == parity_obj.merkle_node(0,0) ):
+			return (-1,None)
+		return (0,diffs[0])
+
+	# exactly one plane in each pair should be off, all by the same delta
+	bad_blk = 0
+	delta = None
+	for j in range(num_bits):
+		d0 = diffs[2*j]
+		d1 = diffs[2*j+1]
+		if( (d0 is None) == (d1 is None) ):
+			return (-2,None)
+		if( d1 is not None ):
+			bad_blk |= (1 << j)
+			dj = d1
+		else:
+			dj = d0
+		if( delta is None ):
+			delta = dj
+		elif( dj != delta ):
+			return (-2,None)
+
+	if( bad_blk >= data_obj.num_blocks ):
+		return (-2,None)
+
+	return (bad_blk,delta)
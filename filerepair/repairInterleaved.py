@@ -25,6 +25,7 @@
 # provide better repair-ability in the event of unrecoverable hardware errors
 
 import utils
+import xorengine
 
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
@@ -43,61 +44,112 @@ def calc_parity( obj ):
 	data = obj.data
 	parity = obj.parity_data
 
-	# TODO: this may already have been zero'd out
+	# XOR each parity-group's disks together, a whole block at a time
+	sums = xorengine.xor_groups( data, num_data_disks, block_size,
+		num_parity_disks, obj.xor_engine )
 	for p in range(num_parity_disks):
-		parity[p] = bytearray( block_size )
-
-	# go through each data-disk and each block
-	for d in range(num_data_disks):
-		# where does this virtual-disk start?
-		st = d * block_size
-		# what parity-group does this disk belong to?
-		p = d % num_parity_disks
-		for i in range(block_size):
-			parity[p][i] ^= data[st+i]
+		parity[p] = sums[p]
 
 	return 0
 
 def repair_errors( data_obj, disk_errors, parity_obj ):
-	# some heavily used values
-	num_data_disks = data_obj.num_data_disks
-	num_parity_disks = data_obj.num_parity_disks
-	block_size = data_obj.block_size
-	data = data_obj.data
-	parity_data = parity_obj.parity_data
-
-	n = len(disk_errors)
-	if( n == 0 ):
+	grp_errors = group_errors( data_obj, disk_errors )
+	if( grp_errors is None ):
+		return -1
+	if( len(grp_errors) == 0 ):
 		# no errors found .. shouldn't really occur
 		return 0
-	if( n > num_parity_disks ):
-		#print "* Error: more than 2 disk errors with RAID-4I .. cannot repair file"
+
+	# only the parity for the damaged groups is needed
+	if( parity_obj.load_parity(list(grp_errors)) != 0 ):
 		return -1
 
-	for ctr in range(n):
-		# : what disk is in error?
-		d1 = disk_errors[ ctr ]
-		# : which parity-interleave-group is in error?
+	# one pass over the data gives the XOR of every group, damaged disks
+	# included
+	sums = xorengine.xor_groups( data_obj.data, data_obj.num_data_disks, data_obj.block_size,
+		data_obj.num_parity_disks, data_obj.xor_engine )
+
+	return fix_groups( data_obj, grp_errors, parity_obj.parity_data, sums )
+
+# the same, after a streaming pass: data_obj's parity is already the XOR of
+# every group as the file is now, so only the damaged blocks themselves
+# have to be read back in
+def repair_streamed( data_obj, disk_errors, parity_obj ):
+	grp_errors = group_errors( data_obj, disk_errors )
+	if( grp_errors is None ):
+		return -1
+	if( parity_obj.load_parity(list(grp_errors)) != 0 ):
+		return -1
+	return fix_groups( data_obj, grp_errors, parity_obj.parity_data, data_obj.parity_data )
+
+# each parity-interleave-group can only rebuild one damaged disk .. returns
+# the damaged disk for each group, or None if it can't be done
+def group_errors( data_obj, disk_errors ):
+	num_parity_disks = data_obj.num_parity_disks
+	if( len(disk_errors) > num_parity_disks ):
+		#print "* Error: more than 2 disk errors with RAID-4I .. cannot repair file"
+		return None
+	grp_errors = {}
+	for d1 in disk_errors:
 		pgrp1 = d1 % num_parity_disks
+		if( pgrp1 in grp_errors ):
+			return None
+		grp_errors[pgrp1] = d1
+	return grp_errors
+
+# since x^x=0, folding the stored parity and the damaged block into the
+# XOR of the damaged group leaves exactly the original contents of that block
+def fix_groups( data_obj, grp_errors, parity_data, sums ):
+	engine = data_obj.xor_engine
+	for pgrp1 in grp_errors:
+		d1 = grp_errors[pgrp1]
+		#print "repairing virtual disk",d1,"from parity data ( disk",pgrp1,")"
+		blk = xorengine.xor_bytes( parity_data[pgrp1], sums[pgrp1], engine )
+		data_obj.set_block( d1, xorengine.xor_bytes(blk,data_obj.get_block(d1),engine) )
+	return 0
+
+# streaming versions of calc_parity .. the parity is built up as each
+# block of the file arrives, so the file never has to be in memory
+def start_parity( obj ):
+	return [ xorengine.new_acc(obj.block_size,obj.xor_engine) for p in range(obj.num_parity_disks) ]
+
+def add_block( obj, state, d, blk ):
+	p = d % obj.num_parity_disks
+	state[p] = xorengine.acc_xor( state[p], blk, obj.xor_engine )
+	return 0
+
+def finish_parity( obj, state ):
+	for p in range(obj.num_parity_disks):
+		obj.parity_data[p] = xorengine.acc_bytes( state[p], obj.block_size, obj.xor_engine )
+	return 0
 
-		#print "repairing virtual disk",d1,"from parity data ( disk",p_disk,")"
-
-		# first, we'll fold in the parity data
-		st1 = d1 * block_size
-		for i in range(block_size):
-			data[st1+i] = parity_data[pgrp1][i]
-
-		# now, go thru the rest of the virtual-disks
-		for d2 in range(num_data_disks):
-			pgrp2 = d2 % num_parity_disks
-			if( (d1!=d2) and (pgrp1==pgrp2) ):
-				#print( "  folding in d="+str(d2)+" ("+str(pgrp2)+")" )
-				st2 = d2 * block_size
-				for i in range(block_size):
-					data[st1+i] ^= data[st2+i]
-
-		#ctr += 1
-		#if( ctr == len(disk_errors) ):
-		#	break
+# updates the parity for a file that has changed since parity_obj was made
+# : deltas[d] = (old block d) ^ (new block d), for the disks whose old
+#   contents we know; disks in dirty changed in ways we can't undo, so
+#   their whole parity-groups are re-summed from the (new) data
+# : disks past the end of the old file were all zeros before
+def update_parity( obj, parity_obj, deltas, dirty ):
+	num_parity_disks = obj.num_parity_disks
+	engine = obj.xor_engine
+	parity = obj.parity_data
+
+	dirty_groups = set( [ d % num_parity_disks for d in dirty ] )
+	for p in range(num_parity_disks):
+		if( p in dirty_groups ):
+			acc = xorengine.new_acc( obj.block_size, engine )
+			for d in range(p,obj.num_data_disks,num_parity_disks):
+				acc = xorengine.acc_xor( acc, obj.get_block(d), engine )
+			parity[p] = xorengine.acc_bytes( acc, obj.block_size, engine )
+		else:
+			parity[p] = bytearray( parity_obj.parity_data[p] )
+
+	for d in deltas:
+		p = d % num_parity_disks
+		if( p not in dirty_groups ):
+			parity[p] = xorengine.xor_bytes( parity[p], deltas[d], engine )
+	for d in range(parity_obj.num_data_disks,obj.num_data_disks):
+		p = d % num_parity_disks
+		if( p not in dirty_groups ):
+			parity[p] = xorengine.xor_bytes( parity[p], obj.get_block(d), engine )
 
 	return 0
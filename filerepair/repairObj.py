@@ -25,11 +25,13 @@
 # provide better repair-ability in the event of unrecoverable hardware errors
 
 import string
-import hashlib
 import binascii
 import time
 import os
 import math
+import mmap
+import struct
+import concurrent.futures
 
 # from . import utils
 # from . import repairInterleaved
@@ -38,11 +40,25 @@ import utils
 import repairInterleaved
 import repairReedsolo
 import repairHypercube
+import xorengine
+import cksums
 
 # the mathematical algorithm/papers suggest rdp_p must be prime and greater than 2
 # known_primes = [ 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59, 61, 67, 71, 73, 79, 83, 89, 97,
 # 	101, 103, 107, 109, 113, 127, 131, 137, 139, 149, 151, 157, 163, 167, 173, 179, 181, 191, 193, 197, 199 ]
 
+# binary .fr file format:
+#   header = magic, version, parity_type, num_parity_disks, num_data_disks,
+#            block_size, file_size, stripe_size, bytes_per_cksum,
+#            cksum_algo, num_sections
+#   then num_sections x (section-id, offset, length)
+#   sections: 'CKSM' = raw digests, 'PRTY' = raw parity blocks,
+#             'MRKL' = (optional) merkle tree over the digests, see calc_merkle
+FR_MAGIC = b'FRPB'
+FR_VERSION = 1
+FR_HEADER = struct.Struct( '<4sHcxIQQQQH16sH' )
+FR_SECTION = struct.Struct( '<4sQQ' )
+
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
@@ -59,11 +75,47 @@ class RepairObj:
 			self.cksum_algo = opts['cksum_algo']
 		else:
 			self.cksum_algo = "SHA1"
+		if( 'xor_engine' in opts ):
+			self.xor_engine = xorengine.check_engine( opts['xor_engine'] )
+		else:
+			self.xor_engine = 'int'
+		if( 'fr_format' in opts ):
+			self.fr_format = opts['fr_format']
+		else:
+			self.fr_format = 'binary'
+		if( 'num_procs' in opts ):
+			self.num_procs = int(opts['num_procs'])
+		else:
+			self.num_procs = 1
+		if( 'segment_size' in opts ):
+			self.segment_size = int(opts['segment_size'])
+		else:
+			self.segment_size = 0
+		if( 'hash_threads' in opts ):
+			self.hash_threads = int(opts['hash_threads'])
+		else:
+			self.hash_threads = 1
+		# 0 = read a block at a time, with no read-ahead thread
+		self.read_size = int( opts.get('read_size',0) )
+		self.queue_depth = int( opts.get('queue_depth',0) )
+		if( 'io_mode' in opts ):
+			self.io_mode = opts['io_mode']
+		else:
+			self.io_mode = 'cached'
+		if( 'merkle' in opts ):
+			self.use_merkle = utils.convert_from_tfyn( opts['merkle'] )
+		else:
+			self.use_merkle = False
+		if( 'use_mmap' in opts ):
+			self.use_mmap = utils.convert_from_tfyn( opts['use_mmap'] )
+		else:
+			self.use_mmap = False
 
 		self.file_size = file_size
 
 		# how many virtual-data-disks are there?
 		self.num_data_disks = utils.intRoundDown( self.file_size, self.block_size )
+		self.num_blocks = self.num_data_disks
 
 		# for hypercube parity system, the num parity disks = num bits in block-coords
 		if( self.parity_type == 'x' ):
@@ -73,49 +125,238 @@ class RepairObj:
 			self.num_parity_disks = 2 * math.ceil( math.log2(n_blks) )
 			self.num_data_disks = 1
 
+		# hypercube parity doesn't need the cksums to find damage
+		self.uses_cksums = (self.parity_type != 'x')
+
+		# Reed-Solomon can only handle 255 symbols (data+parity) at a time, so
+		# bigger files get split into stripes of disks, each with its own parity
+		self.stripe_size = self.num_data_disks
+		if( self.parity_type == 'r' ):
+			max_stripe = 255 - self.num_parity_disks
+			if( ('stripe_size' in opts) and (int(opts['stripe_size']) > 0) ):
+				max_stripe = min( max_stripe, int(opts['stripe_size']) )
+			self.stripe_size = min( self.num_data_disks, max_stripe )
+		self.calc_stripes()
+
 		# temp data area
 		self.data = []
-		self.parity_data = [ [] for p in range(self.num_parity_disks) ]
-
-		# temp cksum area
-		self.disk_cksums = [ 0 for d in range(self.num_data_disks) ]
+		self.repaired_blocks = []
+		# see open_blocks
+		self.data_source = None
+		self.blocks = {}
+		self.blocks_read = []
+		self.parity_data = [ [] for p in range(self.num_parity_blocks) ]
+		self.parity_source = None
 
 		# just so we have it handy .. size of a cksum
-		h = hashlib.new( self.cksum_algo )
-		self.bytes_per_cksum = h.digest_size
+		self.bytes_per_cksum = cksums.digest_size( self.cksum_algo )
+
+		# temp cksum area
+		self.disk_cksums = cksums.DigestTable( self.num_data_disks, self.bytes_per_cksum )
+		self.cksum_source = None
+		self.has_merkle = False
+		self.merkle_levels = None
+		self.merkle_source = None
 
-		self.memory_used = (self.num_data_disks+self.num_parity_disks)*self.block_size
+		self.memory_used = (self.num_data_disks+self.num_parity_blocks)*self.block_size
 		self.memory_used += self.num_data_disks*self.bytes_per_cksum
 
 		return
 
+	# bytes of cksums+parity stored for the file
+	def calc_overhead( self ):
+		return self.num_data_disks*self.bytes_per_cksum + self.num_parity_blocks*self.block_size
+
+	# num_parity_disks is per-stripe; parity block for stripe s, parity-disk p
+	# is at parity_data[s*num_parity_disks+p]
+	def calc_stripes( self ):
+		if( self.stripe_size > 0 ):
+			self.num_stripes = utils.intRoundDown( self.num_data_disks, self.stripe_size )
+		else:
+			self.num_stripes = 1
+		self.num_parity_blocks = self.num_stripes * self.num_parity_disks
+		return 0
+
 	def create_dummy_data( self ):
-		self.data = bytearray( self.num_data_disks*self.block_size )
-		for p in range(self.num_parity_disks):
+		self.data = bytearray( self.num_blocks*self.block_size )
+		for p in range(self.num_parity_blocks):
 			self.parity_data[p] = bytearray( self.block_size )
 		return 0
 
+	# : with use_mmap, self.data is the file mapped into memory (no copy);
+	#   it is only as long as the file, so the zero-padding at the end of
+	#   the last block is "virtual" .. use get_block/set_block to see it
+	# : a mapped file lives in the page cache, so the other io_modes always
+	#   read it into memory
 	def read_file( self, file ):
-		self.data = utils.read_bytearray_file( file )
+		self.data = None
+		self.data_source = None
+		self.repaired_blocks = []
+		if( self.use_mmap and (self.io_mode == 'cached') ):
+			self.data = utils.read_mmap_file( file )
+		if( self.data == None ):
+			self.data = utils.read_bytearray_file( file, self.io_mode )
 		if( self.data == None ):
 			return 1
-		nblks = utils.intRoundDown( len(self.data), self.block_size )
-		if( (nblks*self.block_size) != self.file_size ):
-			# print( "len(data)="+str(len(self.data)) )
-			xtra = abs(self.file_size - nblks*self.block_size)
-			# print( "  adding="+str(xtra) )
-			self.data.extend( [0 for y in range(xtra)] )
-			# print( "  now len(data)="+str(len(self.data)) )
 		return 0
 
 	def write_file( self, file ):
-		err = utils.write_bytearray_file( file, self.data[:self.file_size] )
+		if( self.data_source is not None ):
+			# only the changed blocks are in memory (see open_blocks)
+			return self.write_file_patched( self.data_source, file )
+		if( len(self.data) >= self.file_size ):
+			err = utils.write_bytearray_file( file, memoryview(self.data)[:self.file_size] )
+		else:
+			# file shrank after we got its size
+			err = utils.write_bytearray_file( file, bytes(self.data)+bytes(self.file_size-len(self.data)) )
 		if( err != 0 ):
 			return 1
 		return 0
 
+	# for when only a few blocks of a big file are needed (e.g. update
+	# --append, or repairing after a streaming pass): rather than reading
+	# the file in, get_block reads each block from file as it is asked for,
+	# and set_block keeps the new blocks to one side
+	# : blocks_read lists the blocks that had to be read, in order
+	def open_blocks( self, file ):
+		if( not os.path.isfile(file) ):
+			return 1
+		self.data = None
+		self.data_source = file
+		self.blocks = {}
+		self.blocks_read = []
+		self.repaired_blocks = []
+		return 0
+
+	def read_block( self, d ):
+		st = d * self.block_size
+		n = min( self.block_size, self.file_size-st )
+		blk = utils.read_file_range( self.data_source, st, n )
+		if( (blk is None) or (len(blk) != n) ):
+			raise IOError( "cannot read block %d of file=%s"%(d,self.data_source) )
+		self.blocks_read.append( d )
+		if( n < self.block_size ):
+			blk.extend( bytes(self.block_size-n) )
+		return memoryview( blk )
+
+	# returns virtual-disk/block d .. a zero-copy view if it is all there,
+	# otherwise a zero-padded copy
+	def get_block( self, d ):
+		if( self.data_source is not None ):
+			if( d in self.blocks ):
+				return memoryview( self.blocks[d] )
+			return self.read_block( d )
+		st = d * self.block_size
+		fn = st + self.block_size
+		if( fn <= len(self.data) ):
+			return memoryview( self.data )[st:fn]
+		return xorengine.tail_block( self.data, st, self.block_size )
+
+	# overwrite block d; anything past the end of the data is padding
+	# : the block is remembered so that write_blocks can write just it
+	def set_block( self, d, blk ):
+		if( self.data_source is not None ):
+			self.blocks[d] = bytearray( blk[:self.block_size] )
+		else:
+			st = d * self.block_size
+			n = min( self.block_size, len(self.data)-st )
+			if( n > 0 ):
+				self.data[st:st+n] = blk[:n]
+		if( d not in self.repaired_blocks ):
+			self.repaired_blocks.append( d )
+		return 0
+
+	# which of the repaired blocks don't match check_obj's cksums? .. a
+	# damaged .fr file can rebuild a block wrongly, and that must never be
+	# written over the original
+	def check_repaired( self, check_obj ):
+		bad = []
+		for d in sorted(self.repaired_blocks):
+			if( d >= check_obj.num_data_disks ):
+				continue
+			if( self.calc_one_cksum(self.get_block(d)) != check_obj.merkle_node(0,d) ):
+				bad.append( d )
+		return bad
+
+	# re-write only the blocks that were changed by set_block, leaving the
+	# rest of the file alone
+	# : with check_obj, nothing is written unless every repaired block
+	#   matches its cksum there (returns 2 if not)
+	def write_blocks( self, file, check_obj=None ):
+		try:
+			if( (check_obj is not None) and (len(self.check_repaired(check_obj)) > 0) ):
+				return 2
+			fd = os.open( file, os.O_WRONLY )
+			try:
+				for d in sorted(self.repaired_blocks):
+					st = d * self.block_size
+					n = min( self.block_size, self.file_size-st )
+					if( n > 0 ):
+						os.pwrite( fd, self.get_block(d)[:n], st )
+				os.fsync( fd )
+			finally:
+				os.close( fd )
+		except Exception as e:
+			print( "Exception caught: "+str(e) )
+			return 1
+		return 0
+
+	# copy srcfile (the un-repaired original) to file, then patch in the
+	# repaired blocks
+	def write_file_patched( self, srcfile, file, check_obj=None ):
+		err = utils.copy_file( srcfile, file )
+		if( err != 0 ):
+			return 1
+		try:
+			os.truncate( file, self.file_size )
+		except Exception as e:
+			print( "Exception caught: "+str(e) )
+			return 1
+		return self.write_blocks( file, check_obj )
+
 	# TODO: could/should write cksum of parity-disk to the file
+	# : only the header and cksums are read here; the parity blocks stay in
+	#   the file until load_parity is called, since a healthy file never
+	#   needs them
 	def read_parityfile( self, file ):
+		try:
+			f = open( file, 'rb' )
+			magic = f.read( len(FR_MAGIC) )
+			f.close()
+			if( magic == FR_MAGIC ):
+				return self.read_parityfile_bin( file )
+			return self.read_parityfile_text( file )
+		except Exception as e:
+			print( "Exception caught: "+str(e) )
+			return 1
+		return 0
+
+	# sets up the derived values and temp areas once the header info
+	# (parity_type, num_data_disks, etc.) is known
+	def init_from_header( self ):
+		self.num_blocks = utils.intRoundDown( self.file_size, self.block_size )
+		self.uses_cksums = (self.parity_type != 'x')
+		self.calc_stripes()
+
+		# just so we have it handy .. size of a cksum
+		self.bytes_per_cksum = cksums.digest_size( self.cksum_algo )
+
+		# temp memory areas
+		self.disk_cksums = cksums.DigestTable( self.num_data_disks, self.bytes_per_cksum )
+		self.cksum_source = None
+		self.has_merkle = False
+		self.merkle_levels = None
+		self.merkle_source = None
+		self.data = []
+		self.repaired_blocks = []
+		self.parity_data = [ [] for p in range(self.num_parity_blocks) ]
+		self.parity_source = None
+
+		self.memory_used = (self.num_data_disks+self.num_parity_blocks)*self.block_size
+		self.memory_used += self.num_data_disks*self.bytes_per_cksum
+		return 0
+
+	def read_parityfile_text( self, file ):
 		try:
 			f = open( file, 'r' )
 			txt = f.readline()
@@ -126,33 +367,25 @@ class RepairObj:
 			self.num_parity_disks = int( flds[2] )
 			self.block_size = int( flds[3] )
 			self.file_size = int( flds[4] )
+			# older (and un-striped) files don't have a stripe-size
+			if( len(flds) > 5 ):
+				self.stripe_size = int( flds[5] )
+			else:
+				self.stripe_size = self.num_data_disks
 
 			txt = f.readline()
 			txt = txt.strip()
 			self.cksum_algo = txt
 
-			# temp memory areas
-			self.disk_cksums = [ 0 for d in range(self.num_data_disks) ]
-			self.data = []
-			self.parity_data = [ [] for p in range(self.num_parity_disks) ]
-
-			# just so we have it handy .. size of a cksum
-			h = hashlib.new( self.cksum_algo )
-			self.bytes_per_cksum = h.digest_size
-
-			self.memory_used = (self.num_data_disks+self.num_parity_disks)*self.block_size
-			self.memory_used += self.num_data_disks*self.bytes_per_cksum
+			self.init_from_header()
 
 			for d in range(self.num_data_disks):
 				txt = f.readline()
 				txt = txt.strip()
-				self.disk_cksums[d] = txt
+				self.disk_cksums[d] = bytes.fromhex( txt )
 
-			# now let the parity-disk information
-			for p in range(self.num_parity_disks):
-				txt = f.readline()
-				txt = txt.strip()
-				self.parity_data[p] = bytearray( binascii.unhexlify( txt ) )
+			# the parity-disk information comes next
+			self.parity_source = ( 'text', file, f.tell() )
 
 			f.close()
 		except Exception as e:
@@ -160,16 +393,150 @@ class RepairObj:
 			return 1
 		return 0
 
+	# binary format is a fixed header, a table of (id,offset,length) for
+	# each section, then the sections themselves (raw digests, raw parity)
+	def read_parityfile_bin( self, file ):
+		try:
+			f = open( file, 'rb' )
+			mm = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ )
+			mv = memoryview( mm )
+
+			flds = FR_HEADER.unpack_from( mv, 0 )
+			if( (flds[1] < 1) or (flds[1] > FR_VERSION) ):
+				raise ValueError( "unknown .fr version %d"%(flds[1]) )
+			self.parity_type = flds[2].decode( 'ascii' )
+			self.num_parity_disks = flds[3]
+			self.num_data_disks = flds[4]
+			self.block_size = flds[5]
+			self.file_size = flds[6]
+			self.stripe_size = flds[7]
+			self.cksum_algo = flds[9].rstrip( b'\0' ).decode( 'ascii' )
+			num_sections = flds[10]
+
+			self.init_from_header()
+			if( flds[8] != self.bytes_per_cksum ):
+				raise ValueError( "cksum size does not match cksum algorithm" )
+
+			sections = {}
+			ofs = FR_HEADER.size
+			for i in range(num_sections):
+				(sid,sofs,slen) = FR_SECTION.unpack_from( mv, ofs )
+				sections[sid] = (sofs,slen)
+				ofs += FR_SECTION.size
+
+			nbytes = self.bytes_per_cksum
+			(sofs,slen) = sections[b'CKSM']
+			if( slen < self.num_data_disks*nbytes ):
+				raise ValueError( "cksum section is too short" )
+			if( b'MRKL' in sections ):
+				# with a tree, the cksums are only read as needed (see
+				# merkle_diff and load_cksums)
+				self.cksum_source = ( file, sofs )
+				self.has_merkle = True
+				self.use_merkle = True
+				self.merkle_source = ( file, sections[b'MRKL'][0] )
+			else:
+				self.disk_cksums.load( mv[sofs:sofs+self.num_data_disks*nbytes] )
+
+			(sofs,slen) = sections[b'PRTY']
+			if( slen < self.num_parity_blocks*self.block_size ):
+				raise ValueError( "parity section is too short" )
+			self.parity_source = ( 'bin', file, sofs )
+
+			mv.release()
+			mm.close()
+			f.close()
+		except Exception as e:
+			print( "Exception caught: "+str(e) )
+			return 1
+		return 0
+
+	# reads the parity blocks in plist (default=all) from the .fr file, if
+	# they haven't been already
+	def load_parity( self, plist=None ):
+		if( self.parity_source is None ):
+			return 0
+		if( plist is None ):
+			plist = range( self.num_parity_blocks )
+		plist = [ p for p in plist if len(self.parity_data[p]) == 0 ]
+		if( len(plist) == 0 ):
+			return 0
+
+		(fmt,file,ofs) = self.parity_source
+		try:
+			if( fmt == 'bin' ):
+				f = open( file, 'rb' )
+				for p in plist:
+					f.seek( ofs + p*self.block_size )
+					self.parity_data[p] = bytearray( f.read(self.block_size) )
+			else:
+				# one hex line per block, so we have to read up to the last
+				# one we want .. but only those get decoded
+				f = open( file, 'r' )
+				f.seek( ofs )
+				for p in range(max(plist)+1):
+					txt = f.readline()
+					if( p in plist ):
+						self.parity_data[p] = bytearray( binascii.unhexlify( txt.strip() ) )
+			f.close()
+
+			for p in plist:
+				if( len(self.parity_data[p]) != self.block_size ):
+					self.parity_data[p] = []
+					raise ValueError( "parity block %d is truncated"%(p) )
+		except Exception as e:
+			print( "Exception caught: "+str(e) )
+			return 1
+		return 0
+
+	# reads all of the cksums from the .fr file, if they haven't been already
+	def load_cksums( self ):
+		if( self.cksum_source is None ):
+			return 0
+		try:
+			(file,ofs) = self.cksum_source
+			nbytes = self.bytes_per_cksum
+			self.disk_cksums.load( self.read_fr_bytes(file,ofs,self.num_data_disks*nbytes) )
+			self.cksum_source = None
+		except Exception as e:
+			print( "Exception caught: "+str(e) )
+			return 1
+		return 0
+
+	def read_fr_bytes( self, file, ofs, nbytes ):
+		f = open( file, 'rb' )
+		f.seek( ofs )
+		dat = f.read( nbytes )
+		f.close()
+		if( len(dat) != nbytes ):
+			raise ValueError( ".fr file is truncated" )
+		return dat
+
 	def write_parityfile( self, file ):
+		err = self.load_parity()
+		if( err == 0 ):
+			err = self.load_cksums()
+		if( err != 0 ):
+			return 1
+		if( self.fr_format == 'binary' ):
+			return self.write_parityfile_bin( file )
+		return self.write_parityfile_text( file )
+
+	# : the text format has no merkle tree (it can always be re-built from
+	#   the cksums)
+	def write_parityfile_text( self, file ):
 		try:
 			f = open( file, 'w' )
-			f.write( self.parity_type+','+str(self.num_data_disks)+","+str(self.num_parity_disks)+","+str(self.block_size)+','+str(self.file_size)+"\n" )
+			hdr = self.parity_type+','+str(self.num_data_disks)+","+str(self.num_parity_disks)+","+str(self.block_size)+','+str(self.file_size)
+			if( self.num_stripes > 1 ):
+				hdr += ','+str(self.stripe_size)
+			f.write( hdr+"\n" )
 			f.write( self.cksum_algo+"\n" )
-			for dat in self.disk_cksums:
-				f.write( dat + "\n" )
+			for d in range(self.num_data_disks):
+				f.write( self.disk_cksums.hex(d) + "\n" )
 
 			# now write the parity-disk info
-			for p in range(self.num_parity_disks):
+			for p in range(self.num_parity_blocks):
 				dat = binascii.hexlify( self.parity_data[p])
 				f.write( dat.decode(encoding='utf-8',errors='strict') )
 				f.write( '\n' )
@@ -180,21 +547,298 @@ class RepairObj:
 			return 1
 		return 0
 
+	def write_parityfile_bin( self, file ):
+		try:
+			ckdata = self.disk_cksums.buf
+
+			sections = [ (b'CKSM',len(ckdata)), (b'PRTY',self.num_parity_blocks*self.block_size) ]
+			if( self.use_merkle ):
+				self.calc_merkle()
+				tree = b''.join( [ level.buf for level in self.merkle_levels[1:] ] )
+				sections.append( (b'MRKL',len(tree)) )
+
+			f = open( file, 'wb' )
+			f.write( FR_HEADER.pack( FR_MAGIC, FR_VERSION, self.parity_type.encode('ascii'),
+				self.num_parity_disks, self.num_data_disks, self.block_size,
+				self.file_size, self.stripe_size, self.bytes_per_cksum,
+				self.cksum_algo.encode('ascii'), len(sections) ) )
+			ofs = FR_HEADER.size + len(sections)*FR_SECTION.size
+			for (sid,slen) in sections:
+				f.write( FR_SECTION.pack(sid,ofs,slen) )
+				ofs += slen
+
+			f.write( ckdata )
+			for p in range(self.num_parity_blocks):
+				f.write( self.parity_data[p] )
+			if( self.use_merkle ):
+				f.write( tree )
+
+			f.close()
+		except Exception as e:
+			print( "** ERROR: cannot write repair file: "+str(e) )
+			return 1
+		return 0
+
+	# read the file one block at a time, updating the cksums and the running
+	# parity as we go .. self.data is never filled in, so memory use is
+	# roughly num_parity_blocks blocks no matter how big the file is
+	def can_stream( self ):
+		if( self.parity_type in [ 'i', 'r', 'x' ] ):
+			return True
+		return False
+
+	# : if check_obj is given, each block's cksum is compared against it as
+	#   soon as it is calculated, and mismatch_fn(d) is called for bad disks
+	# : with_parity=False only does the cksums (for a fast verify)
+	def stream_file( self, file, check_obj=None, mismatch_fn=None, with_parity=True ):
+		if( not with_parity ):
+			pmod = None
+		elif( self.parity_type == 'i' ):
+			pmod = repairInterleaved
+		elif( self.parity_type == 'r' ):
+			pmod = repairReedsolo
+		elif( self.parity_type == 'x' ):
+			pmod = repairHypercube
+		else:
+			return 1
+
+		self.memory_used = (self.num_parity_blocks+2)*self.block_size
+		self.memory_used += self.num_data_disks*self.bytes_per_cksum
+		if( self.queue_depth > 0 ):
+			self.memory_used += (self.queue_depth+2)*max(self.read_size,self.block_size)
+
+		try:
+			if( pmod is not None ):
+				state = pmod.start_parity( self )
+			# : for hypercube parity, there are more blocks than cksums
+			d = 0
+			for blk in utils.read_file_blocks( file, self.block_size, self.read_size, self.queue_depth, self.io_mode ):
+				if( d >= self.num_blocks ):
+					break
+				if( d < self.num_data_disks ):
+					self.disk_cksums[d] = self.calc_one_cksum( blk )
+					self.check_one_cksum( d, check_obj, mismatch_fn )
+				if( pmod is not None ):
+					pmod.add_block( self, state, d, blk )
+				d += 1
+			# file may have shrunk since we got its size .. treat as zeros
+			while( d < self.num_data_disks ):
+				blk = bytearray( self.block_size )
+				self.disk_cksums[d] = self.calc_one_cksum( blk )
+				self.check_one_cksum( d, check_obj, mismatch_fn )
+				d += 1
+			if( pmod is not None ):
+				pmod.finish_parity( self, state )
+		except Exception as e:
+			print( "Exception caught: "+str(e) )
+			return 1
+		return 0
+
+	# big files can be split into segments (runs of whole blocks), with one
+	# process per segment mapping in just its part of the file .. the cksums
+	# for each segment are independent, and the parity is linear (XOR, or a
+	# sum over GF(256)) so the partial parity from each segment can just be
+	# XOR'd together
+	# : for interleaved parity, segments are a multiple of num_parity_disks
+	#   blocks (so disks keep their groups), for Reed-Solomon a multiple of
+	#   stripe_size (so each stripe is done by one process)
+	# : hypercube parity depends on every bit of the block index, and the
+	#   other io_modes keep out of the page cache, so those aren't split
+	def can_segment( self ):
+		if( (self.num_procs <= 1) or (self.segment_size <= 0) or (self.io_mode != 'cached') ):
+			return False
+		if( self.parity_type not in [ 'i', 'r' ] ):
+			return False
+		return (self.file_size > self.segment_size)
+
+	def calc_segments( self, file, with_parity=True ):
+		if( self.parity_type == 'r' ):
+			unit = self.stripe_size
+		else:
+			unit = self.num_parity_disks
+		nblks = max( 1, self.segment_size//(unit*self.block_size) ) * unit
+
+		# the workers only need the layout, not the rest of the opts
+		opts = {
+			'parity_type': self.parity_type,
+			'num_parity_disks': self.num_parity_disks,
+			'block_size': self.block_size,
+			'stripe_size': self.stripe_size,
+			'cksum_algo': self.cksum_algo,
+			'xor_engine': self.xor_engine,
+			'hash_threads': self.hash_threads,
+			'use_mmap': self.use_mmap
+		}
+
+		for p in range(self.num_parity_blocks):
+			self.parity_data[p] = bytearray( self.block_size )
+		nbytes = self.bytes_per_cksum
+
+		# just a couple of segments in flight per process, so the results
+		# don't pile up in memory
+		segments = iter( [ (file,d0,min(d0+nblks,self.num_data_disks),self.file_size,opts,with_parity)
+			for d0 in range(0,self.num_data_disks,nblks) ] )
+		pending = set()
+		try:
+			with concurrent.futures.ProcessPoolExecutor( max_workers=self.num_procs ) as pool:
+				while( True ):
+					for args in segments:
+						pending.add( pool.submit(calc_segment,args) )
+						if( len(pending) >= 2*self.num_procs ):
+							break
+					if( len(pending) == 0 ):
+						break
+					(fin,pending) = concurrent.futures.wait( pending, return_when=concurrent.futures.FIRST_COMPLETED )
+					for fut in fin:
+						(d0,digests,parity) = fut.result()
+						self.disk_cksums.buf[d0*nbytes:d0*nbytes+len(digests)] = digests
+						if( parity is None ):
+							continue
+						if( self.parity_type == 'r' ):
+							ofs = (d0//self.stripe_size) * self.num_parity_disks
+						else:
+							ofs = 0
+						for p in range(len(parity)):
+							self.parity_data[ofs+p] = xorengine.xor_bytes( self.parity_data[ofs+p], parity[p], self.xor_engine )
+		except Exception as e:
+			print( "Exception caught: "+str(e) )
+			return 1
+		return 0
+
+	def check_one_cksum( self, d, check_obj, mismatch_fn ):
+		if( check_obj is None ):
+			return 0
+		if( (d < len(check_obj.disk_cksums)) and (self.disk_cksums[d] == check_obj.disk_cksums[d]) ):
+			return 0
+		if( mismatch_fn is not None ):
+			mismatch_fn( d )
+		return 1
+
+	def calc_one_cksum( self, blk ):
+		algo = cksums.new_cksum( self.cksum_algo )
+		algo.update( blk )
+		return algo.digest()
+
 	def calc_cksums( self ):
 		# hypercube approach doesn't need cksums at all
 		# : but with num-data-disks=1, this still works (for whole-file cksum)
-		st = 0
-		fn = self.block_size
-		for d in range(self.num_data_disks):
-			algo = hashlib.new( self.cksum_algo )
-			algo.update( self.data[st:fn] )
-			self.disk_cksums[d] = algo.hexdigest()
+		if( (self.hash_threads > 1) and (self.num_data_disks > 1) ):
+			return self.calc_cksums_threaded()
 
-			st += self.block_size
-			fn += self.block_size
+		self.calc_cksum_range( 0, self.num_data_disks )
 
 		return 0
 
+	def calc_cksum_range( self, st, fn ):
+		for d in range(st,fn):
+			self.disk_cksums[d] = self.calc_one_cksum( self.get_block(d) )
+		return 0
+
+	# hashlib (and zlib) let go of the GIL while hashing a (big enough) block, so
+	# threads can share the work .. each thread gets a run of disks, and
+	# writes into its own slots of disk_cksums, so they stay in order
+	def calc_cksums_threaded( self ):
+		nchunks = min( self.num_data_disks, 4*self.hash_threads )
+		ranges = []
+		for c in range(nchunks):
+			ranges.append( (c*self.num_data_disks//nchunks, (c+1)*self.num_data_disks//nchunks) )
+
+		with concurrent.futures.ThreadPoolExecutor( max_workers=self.hash_threads ) as pool:
+			futs = [ pool.submit(self.calc_cksum_range,st,fn) for (st,fn) in ranges ]
+			for fut in futs:
+				fut.result()
+
+		return 0
+
+	# merkle tree over the (raw) cksums: level 0 is the cksums themselves,
+	# each level up hashes pairs of nodes from the level below (a lone node
+	# at the end of a level is just copied up), and the last level is the
+	# root .. the .fr file stores levels 1 and up, in that order
+	def merkle_sizes( self ):
+		sizes = [ self.num_data_disks ]
+		while( sizes[-1] > 1 ):
+			sizes.append( (sizes[-1]+1)//2 )
+		return sizes
+
+	# : each level is a DigestTable (one flat buffer), and a pair of nodes
+	#   sits side by side in it, so each hash is fed a single slice
+	def calc_merkle( self ):
+		nbytes = self.bytes_per_cksum
+		level = self.disk_cksums
+		self.merkle_levels = [ level ]
+		while( len(level) > 1 ):
+			nxt = cksums.DigestTable( (len(level)+1)//2, nbytes )
+			mv = memoryview( level.buf )
+			for i in range(len(level)//2):
+				st = 2 * i * nbytes
+				algo = cksums.new_cksum( self.cksum_algo )
+				algo.update( mv[st:st+2*nbytes] )
+				nxt.buf[i*nbytes:(i+1)*nbytes] = algo.digest()
+			if( (len(level)%2) == 1 ):
+				nxt.buf[-nbytes:] = mv[-nbytes:]
+			del mv
+			level = nxt
+			self.merkle_levels.append( level )
+		self.has_merkle = True
+		return 0
+
+	# node i of tree-level lvl .. read straight from the .fr file if the
+	# tree (or for level 0, the cksums) hasn't been loaded
+	def merkle_node( self, lvl, i ):
+		if( self.merkle_levels is not None ):
+			return self.merkle_levels[lvl][i]
+		nbytes = self.bytes_per_cksum
+		if( lvl == 0 ):
+			if( self.cksum_source is None ):
+				return self.disk_cksums[i]
+			(file,ofs) = self.cksum_source
+			return self.read_fr_bytes( file, ofs+i*nbytes, nbytes )
+		(file,ofs) = self.merkle_source
+		sizes = self.merkle_sizes()
+		ofs += ( sum(sizes[1:lvl]) + i ) * nbytes
+		return self.read_fr_bytes( file, ofs, nbytes )
+
+	# compares our tree against other's (e.g. from a .fr file), only going
+	# down into subtrees whose hashes don't match .. so a healthy file costs
+	# one comparison (and one read) and each bad disk about 2*log2(n)
+	# : returns the list of disks whose cksums differ
+	def merkle_diff( self, other ):
+		if( self.merkle_levels is None ):
+			self.calc_merkle()
+		sizes = self.merkle_sizes()
+		bad = []
+		todo = []
+		if( sizes[0] > 0 ):
+			todo.append( (len(sizes)-1,0) )
+		while( len(todo) > 0 ):
+			(lvl,i) = todo.pop()
+			if( self.merkle_node(lvl,i) == other.merkle_node(lvl,i) ):
+				continue
+			if( lvl == 0 ):
+				bad.append( i )
+				continue
+			for c in [ 2*i, 2*i+1 ]:
+				if( c < sizes[lvl-1] ):
+					todo.append( (lvl-1,c) )
+		bad.sort()
+		return bad
+
+	# which of our disks have cksums that don't match parity_obj's?
+	# : uses the merkle tree where the .fr file has one (and the number of
+	#   disks hasn't changed), so that only the mis-matched parts are read
+	# : returns None if the cksums can't be read
+	def find_bad_disks( self, parity_obj ):
+		try:
+			if( parity_obj.has_merkle and (self.num_data_disks == parity_obj.num_data_disks) ):
+				return self.merkle_diff( parity_obj )
+		except Exception as e:
+			print( "Exception caught: "+str(e) )
+			return None
+
+		if( parity_obj.load_cksums() != 0 ):
+			return None
+		return self.disk_cksums.mismatches( parity_obj.disk_cksums )
+
 	def calc_parity( self ):
 		if( self.parity_type == 'i' ):
 			repairInterleaved.calc_parity( self )
@@ -207,16 +851,96 @@ class RepairObj:
 			return 1
 		return 0
 
+	# re-uses parity_obj's cksums and parity wherever the file hasn't
+	# changed, rather than re-calculating everything
+	# NOTE: self has the file's (new) data, parity_obj is the old .fr file
+	# : with append_only, the old blocks are assumed not to have changed,
+	#   apart from the old (partial) last block .. which is checked, and if
+	#   it has changed, all of the old blocks are checked after all
+	# : returns 1 if the file can't be updated, and has to be re-created
+	#   (different layout or parity type, or the file shrank)
+	def calc_update( self, parity_obj, append_only=False ):
+		if( self.parity_type == 'i' ):
+			pmod = repairInterleaved
+		elif( self.parity_type == 'r' ):
+			pmod = repairReedsolo
+		else:
+			# hypercube has no per-block cksums, and more blocks can mean
+			# more bit-planes
+			return 1
+		if( (self.parity_type != parity_obj.parity_type)
+				or (self.block_size != parity_obj.block_size)
+				or (self.num_parity_disks != parity_obj.num_parity_disks)
+				or (self.cksum_algo != parity_obj.cksum_algo)
+				or (self.file_size < parity_obj.file_size) ):
+			return 1
+
+		if( (parity_obj.load_cksums() != 0) or (parity_obj.load_parity() != 0) ):
+			return -1
+
+		old_ndisks = parity_obj.num_data_disks
+		nbytes = self.bytes_per_cksum
+		self.disk_cksums.buf[:old_ndisks*nbytes] = parity_obj.disk_cksums.buf[:old_ndisks*nbytes]
+
+		# the old last block may have been partial, and so will have grown
+		changed = []
+		old_tail = None
+		if( (old_ndisks > 0) and (self.file_size > parity_obj.file_size)
+				and ((parity_obj.file_size % self.block_size) != 0) ):
+			d = old_ndisks - 1
+			if( self.calc_one_cksum(self.get_block(d)) != parity_obj.disk_cksums[d] ):
+				changed.append( d )
+				old_tail = self.old_block( parity_obj, d )
+		if( (not append_only) or ((len(changed) > 0) and (old_tail is None)) ):
+			changed = []
+			for d in range(old_ndisks):
+				if( self.calc_one_cksum(self.get_block(d)) != parity_obj.disk_cksums[d] ):
+					changed.append( d )
+
+		for d in changed:
+			self.disk_cksums[d] = self.calc_one_cksum( self.get_block(d) )
+		for d in range(old_ndisks,self.num_data_disks):
+			self.disk_cksums[d] = self.calc_one_cksum( self.get_block(d) )
+
+		# parity is linear, so if we know what a block used to be, the
+		# parity can be patched with (old ^ new) .. otherwise, its part of
+		# the parity has to be re-calculated
+		deltas = {}
+		dirty = []
+		for d in changed:
+			if( (d == old_ndisks-1) and (old_tail is not None) ):
+				deltas[d] = xorengine.xor_bytes( old_tail, self.get_block(d), self.xor_engine )
+			else:
+				dirty.append( d )
+
+		self.merkle_levels = None
+		return pmod.update_parity( self, parity_obj, deltas, dirty )
+
+	# the old contents of disk d, if we can tell what they were: a partial
+	# last block that has since been appended to still starts with the old
+	# bytes, which we can check against the old cksum
+	def old_block( self, parity_obj, d ):
+		if( (d < 0) or (d != parity_obj.num_data_disks-1) ):
+			return None
+		n = parity_obj.file_size - d*self.block_size
+		blk = bytearray( self.block_size )
+		blk[:n] = self.get_block(d)[:n]
+		if( self.calc_one_cksum(blk) != parity_obj.disk_cksums[d] ):
+			return None
+		return blk
+
 	def calc_repair( self, parity_obj ):
 		# NOTE: assumes that self-object has the file's data and raid_objCK
 		#       has the cksum info (but no data)
 
+		# hypercube parity finds the damage from the parity itself
+		if( self.parity_type == 'x' ):
+			return repairHypercube.repair_errors( self, [], parity_obj )
+
 		# go through each cksum
-		disk_errors = []
-		for d in range(self.num_data_disks):
-			if( self.disk_cksums[d] != parity_obj.disk_cksums[d] ):
-				#print "* Warning: cksum on disk",d,"does not match",self.disk_cksums[d],parity_obj.disk_cksums[d]
-				disk_errors.append( d )
+		disk_errors = self.find_bad_disks( parity_obj )
+		if( disk_errors is None ):
+			return -1
 
 		if( len(disk_errors) == 0 ):
 			# no errors found
@@ -226,10 +950,51 @@ class RepairObj:
 			err = repairInterleaved.repair_errors( self, disk_errors, parity_obj )
 		elif( self.parity_type == 'r' ):
 			err = repairReedsolo.repair_errors( self, disk_errors, parity_obj )
-		elif( self.parity_type == 'x' ):
-			err = repairHypercube.repair_errors( self, disk_errors, parity_obj )
 		else:
 			# TODO: throw an error?
 			err = 1
 
 		return err
+
+	# after stream_file (or calc_segments), our parity is that of the file
+	# as it is now, damage and all .. so comparing it with parity_obj's
+	# gives the damage, and only the bad blocks themselves get read back
+	# in from file to fix them
+	def calc_repair_streamed( self, parity_obj, file, disk_errors ):
+		if( self.open_blocks(file) != 0 ):
+			return -1
+		if( self.parity_type == 'i' ):
+			err = repairInterleaved.repair_streamed( self, disk_errors, parity_obj )
+		elif( self.parity_type == 'r' ):
+			err = repairReedsolo.repair_streamed( self, disk_errors, parity_obj )
+		elif( self.parity_type == 'x' ):
+			# finds the damage from the parity anyway
+			err = repairHypercube.repair_errors( self, disk_errors, parity_obj )
+		else:
+			err = 1
+		return err
+
+# worker for calc_segments: treats disks [d0,d1) of the file as a file of
+# their own (mapped in place), and returns its cksums and parity
+def calc_segment( args ):
+	(file,d0,d1,file_size,opts,with_parity) = args
+	block_size = int(opts['block_size'])
+	st = d0 * block_size
+	nbytes = min( d1*block_size, file_size ) - st
+
+	obj = RepairObj( nbytes, opts )
+	if( obj.use_mmap ):
+		obj.data = utils.read_mmap_range( file, st, nbytes )
+	else:
+		obj.data = utils.read_file_range( file, st, nbytes )
+	if( obj.data is None ):
+		raise IOError( "cannot read file="+file )
+	if( with_parity ):
+		obj.calc_parity()
+	obj.calc_cksums()
+
+	if( with_parity ):
+		parity = obj.parity_data
+	else:
+		parity = None
+	return (d0,bytes(obj.disk_cksums.buf),parity)
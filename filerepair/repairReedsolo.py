@@ -24,80 +24,338 @@
 # this code is an attempt at Reed-Solomon techniques on a file, to
 # provide better repair-ability in the event of unrecoverable hardware errors
 
-import string
+import concurrent.futures
 
-import utils
-import reedsolo
+import gf256
+import xorengine
 
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
+# RS messages are limited to 255 symbols, so the data-disks are split into
+# stripes of (at most) stripe_size disks, each with its own parity-disks;
+# stripes are completely independent, so they can be done in parallel
+def stripe_disks( obj, s ):
+	st = s * obj.stripe_size
+	n = min( obj.stripe_size, obj.num_data_disks-st )
+	return (st,n)
+
 # this performs the RS encoding, storing the extra bits to parity drives
 # NOTE: we do this on a block-by-block basis so that we can recover from
 #       whole-sector damage equivalents
+# : every byte-column uses the same parity weights, so rather than calling
+#   rs.encode once per column, we apply the weights to whole blocks at once
+#   (see gf256.py) .. the output is identical
 def calc_parity( obj ):
 	num_data_disks = obj.num_data_disks
 	num_parity_disks = obj.num_parity_disks
-	total_msg_size = num_data_disks + num_parity_disks
 	block_size = obj.block_size
 
 	# ref to data matrices
 	data = obj.data
-	parity = obj.parity_data
+	mv = memoryview( data )
 
-	# create the encoder/decoder
-	#print( "RS codec nsym="+str(num_parity_disks)+" nsize="+str(num_data_disks+num_parity_disks) )
-	rs = reedsolo.RSCodec( nsym=num_parity_disks, nsize=total_msg_size )
+	if( (obj.num_procs > 1) and (obj.num_stripes > 1) ):
+		arglist = []
+		for s in range(obj.num_stripes):
+			(st,n) = stripe_disks( obj, s )
+			arglist.append( (mv[st*block_size:(st+n)*block_size],n,num_parity_disks,block_size,obj.xor_engine) )
+		rtn = map_stripes( calc_stripe_parity, arglist, obj.num_procs )
+		for s in range(obj.num_stripes):
+			for p in range(num_parity_disks):
+				obj.parity_data[s*num_parity_disks+p] = rtn[s][p]
+		return 0
 
-	# TODO: this may already have been zero'd out
-	for p in range(num_parity_disks):
-		parity[p] = bytearray( block_size )
+	state = start_parity( obj )
+	for d in range(num_data_disks):
+		add_block( obj, state, d, obj.get_block(d) )
+	finish_parity( obj, state )
+
+	return 0
+
+# runs fn over each stripe's args (data first) in num_procs processes, and
+# returns the results in order .. memoryviews can't be pickled, so each
+# stripe's data is copied, but only as it is handed out (a couple of
+# stripes per process at a time), so the file never gets copied all at once
+def map_stripes( fn, arglist, num_procs ):
+	rtn = [ None for a in arglist ]
+	pending = {}
+	with concurrent.futures.ProcessPoolExecutor( max_workers=num_procs ) as pool:
+		for i in range(len(arglist)):
+			if( len(pending) >= 2*num_procs ):
+				(fin,notfin) = concurrent.futures.wait( pending, return_when=concurrent.futures.FIRST_COMPLETED )
+				for fut in fin:
+					rtn[ pending.pop(fut) ] = fut.result()
+			a = arglist[i]
+			pending[ pool.submit(fn,(bytes(a[0]),)+a[1:]) ] = i
+		for fut in concurrent.futures.as_completed( list(pending) ):
+			rtn[ pending.pop(fut) ] = fut.result()
+	return rtn
 
-	for i in range(block_size):
-		msg = bytearray( num_data_disks )
-		for d in range(num_data_disks):
+# worker for the parallel version of calc_parity, does just one stripe
+def calc_stripe_parity( args ):
+	(data, num_disks, nsym, block_size, engine) = args
+	codec = gf256.get_codec( nsym )
+	mul_tables = codec['mul_tables']
+	pmatrix = gf256.parity_matrix( codec, num_disks )
+	mv = memoryview( data )
+
+	rtn = []
+	for p in range(nsym):
+		acc = xorengine.new_acc( block_size, engine )
+		for d in range(num_disks):
 			st = d * block_size
-			msg[d] = data[st+i]
-		enc = rs.encode( msg )
-		for p in range(num_parity_disks):
-			parity[p][i] = enc[p+num_data_disks]
+			acc = gf256.acc_muladd( acc, pmatrix[p][d], mv[st:st+block_size], mul_tables, engine )
+		rtn.append( xorengine.acc_bytes(acc,block_size,engine) )
+	return rtn
+
+# streaming versions of calc_parity .. each block gets folded into all of
+# its stripe's parity accumulators as it arrives
+def start_parity( obj ):
+	codec = gf256.get_codec( obj.num_parity_disks )
 
+	# only the last stripe can be short, so these are (mostly) the same
+	# cached matrix
+	pmatrix = []
+	for s in range(obj.num_stripes):
+		(st,n) = stripe_disks( obj, s )
+		pmatrix.append( gf256.parity_matrix(codec,n) )
+
+	state = {
+		'mul_tables': codec['mul_tables'],
+		'pmatrix': pmatrix,
+		'acc': [ xorengine.new_acc(obj.block_size,obj.xor_engine) for p in range(obj.num_parity_blocks) ]
+	}
+	return state
+
+def add_block( obj, state, d, blk ):
+	num_parity_disks = obj.num_parity_disks
+	mul_tables = state['mul_tables']
+	acc = state['acc']
+
+	s = d // obj.stripe_size
+	j = d - s*obj.stripe_size
+	pmatrix = state['pmatrix'][s]
+	for p in range(num_parity_disks):
+		i = s*num_parity_disks + p
+		acc[i] = gf256.acc_muladd( acc[i], pmatrix[p][j], blk, mul_tables, obj.xor_engine )
+	return 0
+
+def finish_parity( obj, state ):
+	for p in range(obj.num_parity_blocks):
+		obj.parity_data[p] = xorengine.acc_bytes( state['acc'][p], obj.block_size, obj.xor_engine )
 	return 0
 
 def repair_errors( data_obj, disk_errors, parity_obj ):
 	# some heavily used values
-	num_data_disks = data_obj.num_data_disks
 	num_parity_disks = data_obj.num_parity_disks
-	total_msg_size = num_data_disks + num_parity_disks
 	block_size = data_obj.block_size
 	data = data_obj.data
-	parity_data = parity_obj.parity_data
 
 	n = len(disk_errors)
 	if( n == 0 ):
 		# no errors found .. shouldn't really occur
 		return 0
-	if( n > (num_parity_disks/2) ):
-		# TODO: this is not 100% accurate, but is a good first approx
+
+	stripe_errors = sort_errors( data_obj, disk_errors, parity_obj )
+	if( stripe_errors is None ):
+		return -1
+	parity_data = parity_obj.parity_data
+
+	mv = memoryview( data )
+	arglist = []
+	for s in stripe_errors:
+		(st,n) = stripe_disks( data_obj, s )
+		stdata = mv[st*block_size:(st+n)*block_size]
+		stparity = parity_data[s*num_parity_disks:(s+1)*num_parity_disks]
+		arglist.append( (stdata,n,num_parity_disks,block_size,data_obj.xor_engine,
+			stripe_errors[s],stparity) )
+
+	if( (data_obj.num_procs > 1) and (len(arglist) > 1) ):
+		rtn = map_stripes( repair_stripe, arglist, data_obj.num_procs )
+	else:
+		rtn = [ repair_stripe(a) for a in arglist ]
+
+	i = 0
+	for s in stripe_errors:
+		if( rtn[i] is None ):
+			return -1
+		(st,n) = stripe_disks( data_obj, s )
+		for j in range(len(stripe_errors[s])):
+			data_obj.set_block( st+stripe_errors[s][j], rtn[i][j] )
+		i += 1
+
+	return 0
+
+# the same, after a streaming pass: data_obj's parity is that of the file
+# as it is now, so (stored ^ ours) is just the damage's share of each parity
+# block, and only the damaged blocks themselves have to be read back in
+def repair_streamed( data_obj, disk_errors, parity_obj ):
+	num_parity_disks = data_obj.num_parity_disks
+	block_size = data_obj.block_size
+	engine = data_obj.xor_engine
+
+	stripe_errors = sort_errors( data_obj, disk_errors, parity_obj )
+	if( stripe_errors is None ):
 		return -1
 
-	# TODO: catch errors thrown by RS library
+	codec = gf256.get_codec( num_parity_disks )
+	for s in stripe_errors:
+		(st,n) = stripe_disks( data_obj, s )
+		errs = stripe_errors[s]
+		synd = []
+		for p in range(len(errs)):
+			i = s*num_parity_disks + p
+			synd.append( xorengine.xor_bytes(parity_obj.parity_data[i],data_obj.parity_data[i],engine) )
+		deltas = solve_erasures( codec, gf256.parity_matrix(codec,n), errs, synd, block_size, engine )
+		if( deltas is None ):
+			return -1
+		for j in range(len(errs)):
+			d = st + errs[j]
+			data_obj.set_block( d, xorengine.xor_bytes(deltas[j],data_obj.get_block(d),engine) )
 
-	# create the encoder/decoder
-	#print( "RS codec nsym="+str(num_parity_disks)+" nsize="+str(num_data_disks+num_parity_disks) )
-	rs = reedsolo.RSCodec( nsym=num_parity_disks, nsize=total_msg_size )
+	return 0
 
-	for i in range(block_size):
-		msg = bytearray( total_msg_size )
-		for d in range(num_data_disks):
+# sorts the bad disks by stripe (as offsets within the stripe), and loads
+# the parity for just those stripes .. None if it can't be done
+def sort_errors( data_obj, disk_errors, parity_obj ):
+	num_parity_disks = data_obj.num_parity_disks
+	stripe_errors = {}
+	for d in disk_errors:
+		s = d // data_obj.stripe_size
+		if( s not in stripe_errors ):
+			stripe_errors[s] = []
+		stripe_errors[s].append( d - s*data_obj.stripe_size )
+
+	# the cksums already told us which disks are bad, so these are erasures
+	# (known positions) and RS can fill in one per parity disk, per stripe
+	for s in stripe_errors:
+		if( len(stripe_errors[s]) > num_parity_disks ):
+			return None
+
+	plist = []
+	for s in stripe_errors:
+		plist.extend( range(s*num_parity_disks,(s+1)*num_parity_disks) )
+	if( parity_obj.load_parity(plist) != 0 ):
+		return None
+	return stripe_errors
+
+# rebuilds the bad disks in one stripe, returns the new blocks (in the
+# same order as disk_errors) or None if it can't be done
+def repair_stripe( args ):
+	(data, num_disks, nsym, block_size, engine, disk_errors, parity_data) = args
+	codec = gf256.get_codec( nsym )
+	mul_tables = codec['mul_tables']
+	pmatrix = gf256.parity_matrix( codec, num_disks )
+	mv = memoryview( data )
+	n = len(disk_errors)
+
+	# re-run the encoder over just the good disks; adding in the stored
+	# parity leaves only the bad disks' share of each parity block:
+	#     synd[p] = sum_j P[p][e_j] * data[e_j]
+	synd = []
+	for p in range(n):
+		acc = xorengine.new_acc( block_size, engine )
+		acc = xorengine.acc_xor( acc, parity_data[p], engine )
+		for d in range(num_disks):
+			if( d in disk_errors ):
+				continue
 			st = d * block_size
-			msg[d] = data[st+i]
+			acc = gf256.acc_muladd( acc, pmatrix[p][d], mv[st:st+block_size], mul_tables, engine )
+		synd.append( xorengine.acc_bytes(acc,block_size,engine) )
+
+	return solve_erasures( codec, pmatrix, disk_errors, synd, block_size, engine )
+
+# solves synd[p] = sum_j P[p][e_j] * x[e_j] for the x's, using the first n
+# parity rows .. the matrix only depends on which disks are bad, so it gets
+# inverted just once and then applied to every column (i.e. whole blocks)
+# at the same time
+def solve_erasures( codec, pmatrix, disk_errors, synd, block_size, engine ):
+	mul_tables = codec['mul_tables']
+	n = len(disk_errors)
+	amat = [ [ pmatrix[p][e] for e in disk_errors ] for p in range(n) ]
+	ainv = gf256.invert_matrix( codec['field'], amat )
+	if( ainv is None ):
+		return None
+
+	rtn = []
+	for j in range(n):
+		acc = xorengine.new_acc( block_size, engine )
+		for p in range(n):
+			acc = gf256.acc_muladd( acc, ainv[j][p], synd[p], mul_tables, engine )
+		rtn.append( xorengine.acc_bytes(acc,block_size,engine) )
+	return rtn
+
+# updates the parity for a file that has changed since parity_obj was made
+# (see repairInterleaved.update_parity) .. RS parity is linear too, so a
+# known delta can be patched in with the same weights
+# : a stripe that has grown (i.e. the file was appended to) doesn't need its
+#   old disks again either; each of their weights just picks up another
+#   factor of x per added disk (see gf256.parity_matrix), so the old parity
+#   is carried forward with shift_parity and only the new disks are added
+# : stripes with dirty disks (or whose layout has changed) have their
+#   parity re-calculated, which is at most 255 blocks per stripe
+def update_parity( obj, parity_obj, deltas, dirty ):
+	num_parity_disks = obj.num_parity_disks
+	block_size = obj.block_size
+	engine = obj.xor_engine
+	parity = obj.parity_data
+	codec = gf256.get_codec( num_parity_disks )
+	mul_tables = codec['mul_tables']
+
+	dirty_stripes = set( [ d // obj.stripe_size for d in dirty ] )
+	for s in range(obj.num_stripes):
+		(st,n) = stripe_disks( obj, s )
+		if( s in dirty_stripes ):
+			blks = b''.join( [ obj.get_block(d) for d in range(st,st+n) ] )
+			rtn = calc_stripe_parity( (blks,n,num_parity_disks,block_size,engine) )
+			for p in range(num_parity_disks):
+				parity[s*num_parity_disks+p] = rtn[p]
+			continue
+
+		# a brand new stripe is just a grown one that had no disks
+		if( s < parity_obj.num_stripes ):
+			(old_st,old_n) = stripe_disks( parity_obj, s )
+			old_parity = parity_obj.parity_data[s*num_parity_disks:(s+1)*num_parity_disks]
+		else:
+			(old_st,old_n) = (st,0)
+			old_parity = [ bytes(block_size) for p in range(num_parity_disks) ]
+		if( (old_st != st) or (old_n > n) ):
+			blks = b''.join( [ obj.get_block(d) for d in range(st,st+n) ] )
+			rtn = calc_stripe_parity( (blks,n,num_parity_disks,block_size,engine) )
+			for p in range(num_parity_disks):
+				parity[s*num_parity_disks+p] = rtn[p]
+			continue
+
+		rtn = shift_parity( codec, old_parity, n-old_n, block_size, engine )
+		pmatrix = gf256.parity_matrix( codec, n )
 		for p in range(num_parity_disks):
-			msg[p+num_data_disks] = parity_data[p][i]
-		dec = rs.decode( msg )
-		for d in range(num_data_disks):
-			st = d * block_size
-			data[st+i] = dec[d]
+			acc = xorengine.new_acc( block_size, engine )
+			acc = xorengine.acc_xor( acc, rtn[p], engine )
+			for d in deltas:
+				if( (d >= st) and (d < st+old_n) ):
+					acc = gf256.acc_muladd( acc, pmatrix[p][d-st], deltas[d], mul_tables, engine )
+			for d in range(st+old_n,st+n):
+				acc = gf256.acc_muladd( acc, pmatrix[p][d-st], obj.get_block(d), mul_tables, engine )
+			parity[s*num_parity_disks+p] = xorengine.acc_bytes( acc, block_size, engine )
 
 	return 0
+
+# multiplies a stripe's parity (the remainder mod the generator, highest
+# degree first) by x^k, a whole block at a time .. the same steps that
+# gf256.make_parity_matrix takes from one disk's weights to the next
+def shift_parity( codec, parity, k, block_size, engine ):
+	gen = codec['gen']
+	mul_tables = codec['mul_tables']
+	nsym = len( parity )
+	rem = [ bytes(p) for p in parity ]
+	for i in range(k):
+		c = rem[0]
+		rem = rem[1:] + [ bytes(block_size) ]
+		for j in range(nsym):
+			acc = xorengine.new_acc( block_size, engine )
+			acc = xorengine.acc_xor( acc, rem[j], engine )
+			acc = gf256.acc_muladd( acc, gen[j+1], c, mul_tables, engine )
+			rem[j] = xorengine.acc_bytes( acc, block_size, engine )
+	return rem
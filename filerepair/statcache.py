@@ -0,0 +1,110 @@
+#!/usr/bin/python
+#
+# (C) 2015-2016, John Pormann, Duke University, jbp1@duke.edu
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#	The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+# persistent per-file state for the '*all' commands, so that repeated runs
+# over a big tree only have to read the files that are new or have changed
+# (plus any that are due to be re-verified)
+#
+# a file counts as unchanged if its (dev, inode, size, mtime_ns, ctime_ns)
+# all match what we saw the last time we processed it .. any write to the
+# file (or replacing it) changes the ctime, but media errors don't, which
+# is why verifyall still re-reads unchanged files every so often
+
+import os
+import sqlite3
+import time
+
+# what to do with a file:
+#   'new'     = never seen it (or it was replaced by another file)
+#   'changed' = same file, but it has been written to since we last saw it
+#   'stale'   = unchanged, but due to be re-verified
+#   'fresh'   = unchanged, and verified recently enough to skip
+NEW = 'new'
+CHANGED = 'changed'
+STALE = 'stale'
+FRESH = 'fresh'
+
+class StatCache:
+	def __init__( self, dbfile, reverify_days=0, reverify_max=0 ):
+		self.dbfile = dbfile
+		# re-verify unchanged files after this many days (0=never)
+		self.reverify_secs = float(reverify_days) * 86400.0
+		# but only this many of them per run (0=no limit), so that the
+		# re-reads get spread out over several runs
+		self.reverify_max = int( reverify_max )
+		self.num_reverify = 0
+		self.num_pending = 0
+		self.now = time.time()
+
+		self.db = sqlite3.connect( dbfile )
+		self.db.execute( 'PRAGMA journal_mode=WAL' )
+		self.db.execute( 'PRAGMA synchronous=NORMAL' )
+		self.db.execute( 'CREATE TABLE IF NOT EXISTS files ( path TEXT PRIMARY KEY,'
+			+ ' dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, ctime_ns INTEGER,'
+			+ ' verified REAL )' )
+		self.db.commit()
+
+	def close( self ):
+		self.db.commit()
+		self.db.close()
+		self.db = None
+
+	# returns (status,st), where st is the os.stat of the file as we
+	# checked it (to hand back to record() once the file is done)
+	def check( self, file ):
+		path = os.path.abspath( file )
+		try:
+			st = os.stat( path )
+		except OSError:
+			return (NEW,None)
+		row = self.db.execute( 'SELECT dev,ino,size,mtime_ns,ctime_ns,verified FROM files WHERE path=?',
+			(path,) ).fetchone()
+		if( row is None ):
+			return (NEW,st)
+		if( (row[0] != st.st_dev) or (row[1] != st.st_ino) ):
+			return (NEW,st)
+		if( (row[2] != st.st_size) or (row[3] != st.st_mtime_ns) or (row[4] != st.st_ctime_ns) ):
+			return (CHANGED,st)
+		if( (self.reverify_secs > 0) and ((self.now-row[5]) >= self.reverify_secs) ):
+			if( (self.reverify_max == 0) or (self.num_reverify < self.reverify_max) ):
+				self.num_reverify += 1
+				return (STALE,st)
+		return (FRESH,st)
+
+	# st should be the stat from before the file was read, so that a file
+	# that changes while we work on it is picked up again next time
+	def record( self, file, st, verified=None ):
+		if( st is None ):
+			return -1
+		if( verified is None ):
+			verified = time.time()
+		path = os.path.abspath( file )
+		self.db.execute( 'INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?)',
+			(path,st.st_dev,st.st_ino,st.st_size,st.st_mtime_ns,st.st_ctime_ns,verified) )
+		# batch up the commits, but don't lose a whole night's work to a crash
+		self.num_pending += 1
+		if( self.num_pending >= 1000 ):
+			self.db.commit()
+			self.num_pending = 0
+		return 0
@@ -25,6 +25,12 @@
 import string
 import fnmatch
 import os
+import mmap
+import math
+import shutil
+import queue
+import threading
+import concurrent.futures
 
 def DefaultOpts():
 	opts = {
@@ -33,6 +39,54 @@ def DefaultOpts():
 		'block_size': 4096,
 		'cksum_algo': 'SHA1',
 		'parity_type': 'i',
+		# bulk XOR backend: int, numpy, or byte
+		'xor_engine': 'int',
+		# max data disks per Reed-Solomon stripe (0=as many as will fit)
+		'stripe_size': 0,
+		# how many CPUs to use for multi-stripe Reed-Solomon calcs, and for
+		# files bigger than segment_size (which get split into segments of
+		# about that many bytes, one process per segment)
+		'num_procs': 1,
+		'segment_size': 1073741824,
+		# how many files the '*all' commands work on at once (processes)
+		'num_jobs': 1,
+		# how many threads to use for calculating the cksums
+		'hash_threads': 1,
+
+		# read the file one block at a time (constant memory)?
+		'streaming': False,
+		# when streaming, read this many bytes at a time in a separate
+		# thread, keeping up to queue_depth reads ahead (0=no read-ahead)
+		'read_size': 1048576,
+		'queue_depth': 2,
+		# verify by cksums only (skip re-calculating the parity)?
+		'fast_verify': False,
+
+		# for update, assume that only new data was added to the end of
+		# the file (rather than checking every block)?
+		'append_only': False,
+
+		# how to write a repaired file:
+		#   copy    = write the whole (repaired) file to the .rep file
+		#   patch   = copy the original to the .rep file, then re-write
+		#             just the repaired blocks
+		#   inplace = re-write just the repaired blocks of the original
+		'repair_mode': 'copy',
+
+		# how to read files: cached, nocache (drop them from the page cache
+		# as we go), or direct (O_DIRECT)
+		'io_mode': 'cached',
+
+		# map the input file rather than reading it into memory?
+		# : saves a copy of the file, but if the file is truncated while it
+		#   is mapped, touching the missing pages kills the process (SIGBUS)
+		#   .. only turn this on for files that nothing else is writing to
+		'use_mmap': False,
+
+		# .fr file format: binary or text (both can always be read)
+		'fr_format': 'binary',
+		# store a merkle tree over the cksums (binary format only)?
+		'merkle': False,
 
 		# assume no options-file
 		'opts_file': None,
@@ -67,6 +121,15 @@ def DefaultOpts():
 		# nice-level for '*all' commands?
 		'nice': 0,
 
+		# remember what each file looked like (in this sqlite file) the last
+		# time an '*all' command saw it, so unchanged files can be skipped
+		'state_db': '',
+		# .. but re-verify unchanged files after this many days (0=never,
+		# which means media errors in unchanged files are never noticed),
+		# at most reverify_max of them per run (0=no limit)
+		'reverify_days': 30,
+		'reverify_max': 0,
+
 		# verbosity of output
 		'verbose': 0
 	}
@@ -82,12 +145,12 @@ def go_nice( opts ):
 
 def read_config_file( file, opts ):
 	try:
-		f = open( file, 'rb' )
+		f = open( file, 'r' )
 		for line in f:
-			txt = string.strip(line)
-			if( txt[0] == '#' ):
+			txt = line.strip()
+			if( (len(txt) == 0) or (txt[0] == '#') ):
 				continue
-			flds = string.split( txt, '=' )
+			flds = [ x.strip() for x in txt.split('=',1) ]
 			if( opts[flds[0]] != None ):
 				if( type(opts[flds[0]]) is bool ):
 					opts[flds[0]] = convert_from_tfyn( flds[1] )
@@ -109,14 +172,14 @@ def file_exists( file ):
 def is_filename_match( filename, config ):
 	if( config['files_default'] == 'include' ):
 		should_process = True
-		list = string.split( config['files_excl'], ',' )
+		list = config['files_excl'].split( ',' )
 		for pattern in list:
 			if( fnmatch.fnmatch(filename,pattern) ):
 				should_process = False
 				break
 	else:
 		should_process = False
-		list = string.split( config['files_incl'], ',' )
+		list = config['files_incl'].split( ',' )
 		for pattern in list:
 			if( fnmatch.fnmatch(filename,pattern) ):
 				should_process = True
@@ -127,14 +190,14 @@ def is_filename_match( filename, config ):
 def is_directory_match( dirname, config ):
 	if( config['dirs_default'] == 'include' ):
 		should_process = True
-		list = string.split( config['dirs_excl'], ',' )
+		list = config['dirs_excl'].split( ',' )
 		for pattern in list:
 			if( fnmatch.fnmatch(dirname,pattern) ):
 				should_process = False
 				break
 	else:
 		should_process = False
-		list = string.split( config['dirs_incl'], ',' )
+		list = config['dirs_incl'].split( ',' )
 		for pattern in list:
 			if( fnmatch.fnmatch(dirname,pattern) ):
 				should_process = True
@@ -142,9 +205,8 @@ def is_directory_match( dirname, config ):
 
 	return should_process
 
-def walk_directory_tree( inpath, opts, command ):
-	err_count = 0
-
+# yields the (full) path of each file that the '*all' commands should process
+def walk_files( inpath, opts ):
 	for curdir, subdirs, files in os.walk(inpath):
 		#print( "walking directory ["+curdir+"]")
 		if( is_directory_match(curdir,opts) ):
@@ -153,10 +215,7 @@ def walk_directory_tree( inpath, opts, command ):
 				infile_full = os.path.join( curdir, infile )
 				if( is_filename_match(infile_full,opts) ):
 					#print( "  processing" )
-					err = command( infile_full, opts )
-					# TODO: verify this is an error, only count errors
-					#       (not sum error-return codes)
-					err_count = err_count + err
+					yield infile_full
 
 		tmplist = [ d for d in subdirs ]
 		for d in tmplist:
@@ -167,6 +226,56 @@ def walk_directory_tree( inpath, opts, command ):
 				#print( "  removing dir ["+d+"]" )
 				subdirs.remove( d )
 
+def walk_directory_tree( inpath, opts, command ):
+	return run_jobs( walk_files(inpath,opts), command, opts, int(opts['num_jobs']) )
+
+# calls command(task,opts) for each task, spread over num_jobs processes
+# (command must be a module-level function, so that it can be pickled) ..
+# tasks can be a generator, and only a couple of tasks per process are
+# pulled from it at a time, so a huge directory walk doesn't pile up in
+# memory while the workers are busy on big files
+# : done(task,err) is called (in this process) as each task finishes
+def run_jobs( tasks, command, opts, num_jobs=1, done=None ):
+	err_count = 0
+
+	if( num_jobs <= 1 ):
+		for task in tasks:
+			err = command( task, opts )
+			if( done != None ):
+				done( task, err )
+			# TODO: verify this is an error, only count errors
+			#       (not sum error-return codes)
+			err_count = err_count + err
+		return err_count
+
+	def finish( fut ):
+		task = pending.pop( fut )
+		try:
+			err = fut.result()
+		except Exception as e:
+			print( "Exception caught: "+str(e) )
+			err = -1
+		if( done != None ):
+			done( task, err )
+		return err
+
+	pending = {}
+	try:
+		with concurrent.futures.ProcessPoolExecutor( max_workers=num_jobs ) as pool:
+			for task in tasks:
+				if( len(pending) >= 2*num_jobs ):
+					(fin,notfin) = concurrent.futures.wait( pending, return_when=concurrent.futures.FIRST_COMPLETED )
+					for fut in fin:
+						err_count = err_count + finish( fut )
+				pending[ pool.submit(command,task,opts) ] = task
+			for fut in concurrent.futures.as_completed( list(pending) ):
+				err_count = err_count + finish( fut )
+	except concurrent.futures.process.BrokenProcessPool as e:
+		# a worker died (e.g. killed for using too much memory), which
+		# takes the whole pool with it .. the rest of the files aren't done
+		print( "Exception caught: "+str(e) )
+		err_count = err_count - 1
+
 	return err_count
 
 # Assumes infile is a "full" relative path (from top of local tree)
@@ -203,7 +312,7 @@ def convert_from_tfyn( text ):
 	if( type(text) is bool ):
 		rtn = text
 	elif( type(text) is str ):
-		txt = string.lower(text)
+		txt = text.lower()
 		txt = txt[0]
 		if( (txt=='y') or (txt=='t') ):
 			rtn = True
@@ -247,15 +356,297 @@ def convert_to_kmgt( inval ):
 		rtn = str(inval) + "B"
 	return rtn
 
-def read_bytearray_file( file ):
+# how files get read (opts['io_mode']):
+#   cached  = normal reads, through the page cache
+#   nocache = read sequentially, and tell the kernel to drop each part of
+#             the file from the page cache once we're done with it
+#   direct  = O_DIRECT reads into aligned buffers, bypassing the page cache
+#             (falls back to nocache if the filesystem won't do O_DIRECT)
+# : so a big scrub doesn't push everyone else's data out of the cache
+IO_ALIGN = 4096
+
+def open_read_fd( file, io_mode ):
+	fd = -1
+	direct = False
+	if( (io_mode == 'direct') and hasattr(os,'O_DIRECT') ):
+		try:
+			fd = os.open( file, os.O_RDONLY|os.O_DIRECT )
+			direct = True
+		except OSError:
+			fd = -1
+	if( fd < 0 ):
+		fd = os.open( file, os.O_RDONLY )
+	if( (io_mode != 'cached') and hasattr(os,'posix_fadvise') ):
+		os.posix_fadvise( fd, 0, 0, os.POSIX_FADV_SEQUENTIAL )
+	return (fd,direct)
+
+# O_DIRECT needs page-aligned buffers (anonymous mmaps always are)
+def alloc_read_buffer( size, direct ):
+	if( direct ):
+		return mmap.mmap( -1, size )
+	return bytearray( size )
+
+# bytes per read: a whole number of blocks, and for O_DIRECT also a whole
+# number of IO_ALIGN units (so every read starts on an aligned offset)
+def read_chunk_size( block_size, read_size, direct ):
+	chunk_size = max( 1, read_size//block_size ) * block_size
+	if( direct ):
+		unit = block_size * IO_ALIGN // math.gcd( block_size, IO_ALIGN )
+		chunk_size = ((chunk_size+unit-1)//unit) * unit
+	return chunk_size
+
+# fill buf from offset, returns the number of bytes read (short only at EOF)
+def read_fd_chunk( fd, buf, offset, io_mode, direct ):
+	mv = memoryview( buf )
+	n = 0
+	while( n < len(mv) ):
+		k = os.preadv( fd, [mv[n:]], offset+n )
+		if( k == 0 ):
+			break
+		n += k
+		if( direct ):
+			# can't continue from an un-aligned spot; short means EOF
+			break
+	mv.release()
+	if( (io_mode == 'nocache') or ((io_mode == 'direct') and not direct) ):
+		if( (n > 0) and hasattr(os,'posix_fadvise') ):
+			os.posix_fadvise( fd, offset, n, os.POSIX_FADV_DONTNEED )
+	return n
+
+def read_bytearray_file( file, io_mode='cached' ):
+	try:
+		if( io_mode == 'cached' ):
+			f = open( file, 'rb' )
+			data = bytearray( f.read() )
+			f.close()
+		else:
+			data = read_bytearray_file_uncached( file, io_mode )
+	except:
+		return None
+	return data
+
+def read_bytearray_file_uncached( file, io_mode ):
+	(fd,direct) = open_read_fd( file, io_mode )
+	try:
+		size = os.fstat( fd ).st_size
+		data = bytearray( size )
+		chunk_size = read_chunk_size( IO_ALIGN, 1048576, direct )
+		if( direct ):
+			buf = alloc_read_buffer( chunk_size, direct )
+		dmv = memoryview( data )
+		ofs = 0
+		while( ofs < size ):
+			if( direct ):
+				# bounce through the aligned buffer
+				n = min( read_fd_chunk(fd,buf,ofs,io_mode,direct), size-ofs )
+				dmv[ofs:ofs+n] = buf[:n]
+			else:
+				n = read_fd_chunk( fd, dmv[ofs:ofs+chunk_size], ofs, io_mode, direct )
+			if( n == 0 ):
+				break
+			ofs += n
+		dmv.release()
+		if( ofs < size ):
+			# file shrank while we were reading it
+			del data[ofs:]
+	finally:
+		os.close( fd )
+	return data
+
+# map a file into memory rather than copying it .. ACCESS_COPY means that
+# writes (i.e. repairs) go to private pages and never touch the file itself
+# : returns None if the file can't be mapped (e.g. not a regular file)
+def read_mmap_file( file ):
 	try:
 		f = open( file, 'rb' )
-		data = bytearray( f.read() )
-		f.close()
+		try:
+			if( os.fstat(f.fileno()).st_size == 0 ):
+				# can't mmap an empty file
+				return bytearray()
+			size = os.fstat(f.fileno()).st_size
+			data = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_COPY )
+			# if it shrank while we were mapping it, don't go near it
+			if( os.fstat(f.fileno()).st_size != size ):
+				data.close()
+				return None
+		finally:
+			f.close()
+	except:
+		return None
+	return data
+
+# maps in just [offset,offset+length) of a file (read-only) .. mmap offsets
+# have to be page-aligned, so the returned view skips over the extra bytes
+# : if the file has shrunk, the view stops at the end of the file
+def read_mmap_range( file, offset, length ):
+	try:
+		f = open( file, 'rb' )
+		try:
+			length = min( length, os.fstat(f.fileno()).st_size-offset )
+			if( length <= 0 ):
+				return bytearray()
+			st = offset - (offset % mmap.ALLOCATIONGRANULARITY)
+			data = mmap.mmap( f.fileno(), length+offset-st, offset=st, access=mmap.ACCESS_READ )
+		finally:
+			f.close()
+	except:
+		return None
+	return memoryview( data )[offset-st:offset-st+length]
+
+# reads just [offset,offset+length) of a file, stopping early if the file
+# has shrunk
+def read_file_range( file, offset, length ):
+	try:
+		fd = os.open( file, os.O_RDONLY )
+		try:
+			data = bytearray( max(0,length) )
+			mv = memoryview( data )
+			n = 0
+			while( n < length ):
+				k = os.preadv( fd, [mv[n:]], offset+n )
+				if( k <= 0 ):
+					break
+				n += k
+		finally:
+			os.close( fd )
 	except:
 		return None
+	del mv
+	del data[n:]
 	return data
 
+# copy a file, letting the kernel do it (and share the extents, on
+# filesystems that can) where possible
+def copy_file( src, dst ):
+	try:
+		fin = open( src, 'rb' )
+		fout = open( dst, 'wb' )
+		try:
+			try:
+				nleft = os.fstat( fin.fileno() ).st_size
+				while( nleft > 0 ):
+					n = os.copy_file_range( fin.fileno(), fout.fileno(), nleft )
+					if( n == 0 ):
+						break
+					nleft -= n
+			except (AttributeError,OSError):
+				# no copy_file_range (or not across these filesystems)
+				fin.seek( 0 )
+				fout.seek( 0 )
+				fout.truncate()
+				shutil.copyfileobj( fin, fout )
+		finally:
+			fout.close()
+			fin.close()
+	except:
+		return 1
+	return 0
+
+# read a file one block at a time, zero-padding the last block
+# : with queue_depth > 0, a reader thread reads ahead (read_size bytes at a
+#   time) into a ring of buffers while the caller works on the blocks it
+#   already has .. those blocks are views into the ring, so they are only
+#   good until the next block is asked for
+def read_file_blocks( file, block_size, read_size=0, queue_depth=0, io_mode='cached' ):
+	if( queue_depth > 0 ):
+		return read_file_blocks_ahead( file, block_size, read_size, queue_depth, io_mode )
+	return read_file_blocks_serial( file, block_size, io_mode )
+
+def read_file_blocks_serial( file, block_size, io_mode='cached' ):
+	if( io_mode != 'cached' ):
+		yield from read_file_blocks_uncached( file, block_size, io_mode )
+		return
+	f = open( file, 'rb' )
+	try:
+		while( True ):
+			blk = f.read( block_size )
+			if( len(blk) == 0 ):
+				break
+			if( len(blk) < block_size ):
+				blk = blk + bytes( block_size-len(blk) )
+			yield blk
+	finally:
+		f.close()
+
+def read_file_blocks_uncached( file, block_size, io_mode ):
+	(fd,direct) = open_read_fd( file, io_mode )
+	try:
+		chunk_size = read_chunk_size( block_size, block_size, direct )
+		buf = alloc_read_buffer( chunk_size, direct )
+		ofs = 0
+		while( True ):
+			n = read_fd_chunk( fd, buf, ofs, io_mode, direct )
+			for blk in split_blocks( buf, n, block_size ):
+				yield bytes( blk )
+			if( n < chunk_size ):
+				break
+			ofs += n
+	finally:
+		os.close( fd )
+
+# the first n bytes of buf, as block_size views (zero-padding the last)
+def split_blocks( buf, n, block_size ):
+	mv = memoryview( buf )
+	for st in range(0,n,block_size):
+		if( (n-st) < block_size ):
+			blk = bytearray( block_size )
+			blk[:n-st] = mv[st:n]
+			yield blk
+		else:
+			yield mv[st:st+block_size]
+
+def read_file_blocks_ahead( file, block_size, read_size, queue_depth, io_mode='cached' ):
+	(fd,direct) = open_read_fd( file, io_mode )
+	chunk_size = read_chunk_size( block_size, read_size, direct )
+
+	# queue_depth buffers waiting, plus one being filled and one in use
+	free_q = queue.Queue()
+	for i in range(queue_depth+2):
+		free_q.put( alloc_read_buffer(chunk_size,direct) )
+	full_q = queue.Queue( queue_depth )
+	stop = threading.Event()
+
+	# : the caller may stop early, so never block forever
+	def put_full( item ):
+		while( not stop.is_set() ):
+			try:
+				full_q.put( item, timeout=0.1 )
+				return
+			except queue.Full:
+				pass
+
+	def reader():
+		try:
+			ofs = 0
+			while( not stop.is_set() ):
+				try:
+					buf = free_q.get( timeout=0.1 )
+				except queue.Empty:
+					continue
+				n = read_fd_chunk( fd, buf, ofs, io_mode, direct )
+				put_full( (buf,n) )
+				if( n < chunk_size ):
+					break
+				ofs += n
+		except Exception as e:
+			put_full( (None,e) )
+
+	thr = threading.Thread( target=reader, daemon=True )
+	thr.start()
+	try:
+		while( True ):
+			(buf,n) = full_q.get()
+			if( buf is None ):
+				raise n
+			yield from split_blocks( buf, n, block_size )
+			free_q.put( buf )
+			if( n < chunk_size ):
+				break
+	finally:
+		stop.set()
+		thr.join()
+		os.close( fd )
+
 def write_bytearray_file( file, data ):
 	try:
 		f = open( file, 'wb' )
@@ -0,0 +1,244 @@
+#!/usr/bin/python
+#
+# (C) 2015-2016, John Pormann, Duke University, jbp1@duke.edu
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#	The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# bulk XOR routines for the parity calcs .. these work on whole blocks
+# at a time, rather than looping over every byte in the interpreter
+#
+# available engines (set with opts['xor_engine']):
+#   'int'   = wide-integer XOR (python ints built from memoryview slices)
+#   'numpy' = numpy uint8/uint64 arrays (falls back to 'int' if no numpy)
+#   'byte'  = original byte-at-a-time loops (slow, but handy for testing)
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+engine_list = [ 'int', 'numpy', 'byte' ]
+
+def check_engine( engine ):
+	if( engine not in engine_list ):
+		return 'int'
+	if( (engine == 'numpy') and (numpy is None) ):
+		return 'int'
+	return engine
+
+def to_int( blk ):
+	return int.from_bytes( blk, 'little' )
+
+def from_int( val, nbytes ):
+	return bytearray( val.to_bytes(nbytes,'little') )
+
+# XOR two equal-length blocks, returning a new bytearray
+def xor_bytes( a, b, engine='int' ):
+	if( engine == 'numpy' ):
+		arr = numpy.bitwise_xor( numpy.frombuffer(a,dtype=numpy.uint8),
+			numpy.frombuffer(b,dtype=numpy.uint8) )
+		return bytearray( arr.tobytes() )
+	elif( engine == 'byte' ):
+		rtn = bytearray( a )
+		for i in range(len(rtn)):
+			rtn[i] ^= b[i]
+		return rtn
+	return from_int( to_int(a)^to_int(b), len(a) )
+
+# the bulk routines below take the raw file data (e.g. an mmap), which may
+# stop part-way through the last block .. anything past the end of data is
+# treated as zeros, without making a padded copy of the whole thing
+def tail_block( data, st, block_size ):
+	blk = bytearray( block_size )
+	if( st < len(data) ):
+		blk[:len(data)-st] = data[st:st+block_size]
+	return blk
+
+# XOR the virtual-disks together by interleave-group, i.e. group g is the
+# XOR of all disks d where (d % num_groups) == g
+def xor_groups( data, num_disks, block_size, num_groups, engine='int' ):
+	if( engine == 'numpy' ):
+		return xor_groups_numpy( data, num_disks, block_size, num_groups )
+	elif( engine == 'byte' ):
+		return xor_groups_byte( data, num_disks, block_size, num_groups )
+	return xor_groups_int( data, num_disks, block_size, num_groups )
+
+def xor_groups_int( data, num_disks, block_size, num_groups ):
+	# consecutive runs of num_groups disks line up with the groups, so
+	# we can XOR a whole "row" of disks at once and split it at the end
+	row_size = num_groups * block_size
+	nbytes = num_disks * block_size
+	mv = memoryview( data )
+
+	acc = 0
+	for st in range(0,nbytes,row_size):
+		fn = min( st+row_size, nbytes )
+		# little-endian, so a short last row is implicitly zero-padded
+		acc ^= int.from_bytes( mv[st:fn], 'little' )
+
+	row = from_int( acc, row_size )
+	rtn = []
+	for g in range(num_groups):
+		st = g * block_size
+		rtn.append( row[st:st+block_size] )
+	return rtn
+
+def xor_groups_numpy( data, num_disks, block_size, num_groups ):
+	# use 8-byte words where we can
+	if( (block_size%8) == 0 ):
+		dtype = numpy.uint64
+		nwords = block_size // 8
+	else:
+		dtype = numpy.uint8
+		nwords = block_size
+	# only whole blocks can be viewed in-place
+	nfull = min( num_disks, len(data)//block_size )
+	arr = numpy.frombuffer( data, dtype=dtype, count=nfull*nwords )
+	arr = arr.reshape( (nfull,nwords) )
+
+	rtn = []
+	for g in range(num_groups):
+		if( g < nfull ):
+			acc = numpy.bitwise_xor.reduce( arr[g::num_groups], axis=0 )
+			rtn.append( bytearray(acc.tobytes()) )
+		else:
+			rtn.append( bytearray(block_size) )
+	if( (nfull < num_disks) and (nfull*block_size < len(data)) ):
+		g = nfull % num_groups
+		rtn[g] = xor_bytes( rtn[g], tail_block(data,nfull*block_size,block_size), 'numpy' )
+	return rtn
+
+def xor_groups_byte( data, num_disks, block_size, num_groups ):
+	rtn = [ bytearray(block_size) for g in range(num_groups) ]
+	for d in range(num_disks):
+		st = d * block_size
+		p = d % num_groups
+		for i in range(min(block_size,len(data)-st)):
+			rtn[p][i] ^= data[st+i]
+	return rtn
+
+# running XOR accumulators, for when the blocks arrive one at a time
+# (e.g. while streaming a file) .. always use the returned value, since
+# the 'int' engine can't update in-place
+# : blk may be shorter than the accumulator (i.e. zero-padded)
+def new_acc( block_size, engine='int' ):
+	if( engine == 'numpy' ):
+		return numpy.zeros( block_size, dtype=numpy.uint8 )
+	elif( engine == 'byte' ):
+		return bytearray( block_size )
+	return 0
+
+def acc_xor( acc, blk, engine='int' ):
+	if( engine == 'numpy' ):
+		n = len( blk )
+		numpy.bitwise_xor( acc[:n], numpy.frombuffer(blk,dtype=numpy.uint8), out=acc[:n] )
+		return acc
+	elif( engine == 'byte' ):
+		for i in range(len(blk)):
+			acc[i] ^= blk[i]
+		return acc
+	return acc ^ to_int( blk )
+
+def acc_bytes( acc, block_size, engine='int' ):
+	if( engine == 'numpy' ):
+		return bytearray( acc.tobytes() )
+	elif( engine == 'byte' ):
+		return bytearray( acc )
+	return from_int( acc, block_size )
+
+# XOR the blocks together by bit-plane of their block-index (for hypercube
+# parity): plane 2*j+1 is the XOR of all blocks with bit j set in their
+# index, plane 2*j is the XOR of all blocks with bit j clear
+def xor_bitplanes( data, num_blocks, block_size, num_bits, engine='int' ):
+	if( engine == 'numpy' ):
+		return xor_bitplanes_numpy( data, num_blocks, block_size, num_bits )
+	elif( engine == 'byte' ):
+		return xor_bitplanes_byte( data, num_blocks, block_size, num_bits )
+	return xor_bitplanes_int( data, num_blocks, block_size, num_bits )
+
+def xor_bitplanes_int( data, num_blocks, block_size, num_bits ):
+	mv = memoryview( data )
+	total = 0
+	ones = [ 0 for j in range(num_bits) ]
+	for b in range(num_blocks):
+		st = b * block_size
+		val = int.from_bytes( mv[st:st+block_size], 'little' )
+		total ^= val
+		j = 0
+		bits = b
+		while( bits ):
+			if( bits & 1 ):
+				ones[j] ^= val
+			bits >>= 1
+			j += 1
+
+	# the "zero" half of each plane is whatever isn't in the "one" half
+	rtn = []
+	for j in range(num_bits):
+		rtn.append( from_int(total^ones[j],block_size) )
+		rtn.append( from_int(ones[j],block_size) )
+	return rtn
+
+# : the blocks with bit j set come in runs of 2^j, every 2^(j+1) blocks, so
+#   reshaping to (-1,2,2^j,nwords) and taking [:,1] picks them out as a
+#   strided view (no copy); the blocks past the last whole run are done
+#   separately, and the "zero" plane is the total XOR'd with the "one" plane
+def xor_bitplanes_numpy( data, num_blocks, block_size, num_bits ):
+	# use 8-byte words where we can
+	if( (block_size%8) == 0 ):
+		dtype = numpy.uint64
+		nwords = block_size // 8
+	else:
+		dtype = numpy.uint8
+		nwords = block_size
+	nfull = min( num_blocks, len(data)//block_size )
+	arr = numpy.frombuffer( data, dtype=dtype, count=nfull*nwords )
+	arr = arr.reshape( (nfull,nwords) )
+	zero = numpy.zeros( nwords, dtype=dtype )
+
+	total = numpy.bitwise_xor.reduce( arr, axis=0 ) if (nfull > 0) else zero
+	rtn = []
+	for j in range(num_bits):
+		run = 1 << j
+		m = (nfull >> (j+1)) << (j+1)
+		ones = zero
+		if( m > 0 ):
+			view = arr[:m].reshape( (-1,2,run,nwords) )[:,1]
+			ones = numpy.bitwise_xor.reduce( view, axis=(0,1) )
+		if( (m+run) < nfull ):
+			ones = ones ^ numpy.bitwise_xor.reduce( arr[m+run:nfull], axis=0 )
+		rtn.append( bytearray((total^ones).tobytes()) )
+		rtn.append( bytearray(ones.tobytes()) )
+	if( (nfull < num_blocks) and (nfull*block_size < len(data)) ):
+		tail = tail_block( data, nfull*block_size, block_size )
+		for j in range(num_bits):
+			p = 2*j + ((nfull >> j) & 1)
+			rtn[p] = xor_bytes( rtn[p], tail, 'numpy' )
+	return rtn
+
+def xor_bitplanes_byte( data, num_blocks, block_size, num_bits ):
+	rtn = [ bytearray(block_size) for p in range(2*num_bits) ]
+	for b in range(num_blocks):
+		st = b * block_size
+		for j in range(num_bits):
+			p = 2*j + ((b >> j) & 1)
+			for i in range(min(block_size,len(data)-st)):
+				rtn[p][i] ^= data[st+i]
+	return rtn
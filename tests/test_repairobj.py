@@ -26,9 +26,58 @@
 
 
 import unittest
+import os
+import io
+import re
+import contextlib
+import tempfile
 
 import filerepair.repairObj as repairObj
 import filerepair.utils as utils
+import filerepair.cksums as cksums
+import filerepair.xorengine as xorengine
+import filerepair.statcache as statcache
+import filerepair.filerepair as filerepair
+
+# stand-in for the '*all' commands (has to be module-level to be pickled)
+def job_err( task, opts ):
+	return task % 3
+
+# the bytes that the repair tests use for a file, different in every block
+def make_pattern( file_size, bsize, mult=13 ):
+	return bytearray( [ (i*mult+i//bsize) % 256 for i in range(file_size) ] )
+
+# an object holding make_pattern's data, with its parity and cksums done
+# (i.e. what a .fr file made from it would hold)
+def make_good_obj( file_size, opts, mult=13 ):
+	obj = repairObj.RepairObj( file_size, opts )
+	obj.create_dummy_data()
+	obj.data[:file_size] = make_pattern( file_size, obj.block_size, mult )
+	obj.calc_parity()
+	obj.calc_cksums()
+	return obj
+
+# a copy of good_obj's data with the bytes at bad_offsets flipped, ready for
+# calc_repair(good_obj) .. hypercube finds the damage from the parity rather
+# than the cksums, so that gets re-calculated too
+def make_bad_obj( good_obj, opts, bad_offsets ):
+	obj = repairObj.RepairObj( good_obj.file_size, opts )
+	obj.data = bytearray( good_obj.data )
+	for ofs in bad_offsets:
+		obj.data[ofs] ^= 0xff
+	obj.calc_cksums()
+	if( obj.parity_type == 'x' ):
+		obj.calc_parity()
+	return obj
+
+# runs fn(*args), returning what it returned along with the disks whose
+# cksums it logged as bad
+def run_logged( fn, *args ):
+	out = io.StringIO()
+	with contextlib.redirect_stdout( out ):
+		rtn = fn( *args )
+	bad = re.findall( r'cksum on disk (\d+) does not match', out.getvalue() )
+	return ( rtn, sorted( [ int(d) for d in bad ] ) )
 
 class repairObjTests( unittest.TestCase ):
 
@@ -80,6 +129,212 @@ class repairObjTests( unittest.TestCase ):
 
 		self.assertEqual( err, 0 )
 
+	def test_xor_engines(self):
+		err = 0
+
+		opts = utils.DefaultOpts()
+
+		for nparity in [ 1,3,4 ]:
+			opts['num_parity_disks'] = nparity
+
+			for bsize in [ 1000,1024 ]:
+				opts['block_size'] = bsize
+
+				# odd-sized "file" so the last row of disks is partial
+				file_size = 11 * bsize + 17
+
+				pdata_list = []
+				for engine in [ 'byte','int' ]:
+					opts['xor_engine'] = engine
+
+					repair_obj = repairObj.RepairObj( file_size, opts )
+					repair_obj.create_dummy_data()
+					repair_obj.data[:file_size] = make_pattern( file_size, bsize, 7 )
+
+					repair_obj.calc_parity()
+					pdata_list.append( repair_obj.parity_data )
+
+				for pdata in pdata_list[1:]:
+					if( pdata != pdata_list[0] ):
+						err = err + 1
+
+		self.assertEqual( err, 0 )
+
+	def test_interleaved_repair(self):
+		err = 0
+
+		opts = utils.DefaultOpts()
+
+		for nparity in [ 1,2,4 ]:
+			opts['num_parity_disks'] = nparity
+			bsize = 1024
+			opts['block_size'] = bsize
+			file_size = 10 * bsize + 100
+
+			good_obj = make_good_obj( file_size, opts )
+
+			# damage one disk in each parity-group
+			bad_obj = make_bad_obj( good_obj, opts, [ d*bsize+d for d in range(nparity) ] )
+
+			if( bad_obj.calc_repair(good_obj) != 0 ):
+				err = err + 1
+			if( bad_obj.data != good_obj.data ):
+				err = err + 1
+
+		self.assertEqual( err, 0 )
+
+	def test_hypercube(self):
+		err = 0
+
+		opts = utils.DefaultOpts()
+		opts['parity_type'] = 'x'
+		bsize = 256
+		opts['block_size'] = bsize
+
+		for nblks in [ 2,5,16 ]:
+			file_size = nblks * bsize - 7
+
+			pdata_list = []
+			for engine in [ 'byte','int' ]:
+				opts['xor_engine'] = engine
+
+				repair_obj = repairObj.RepairObj( file_size, opts )
+				repair_obj.create_dummy_data()
+				repair_obj.data[:file_size] = make_pattern( file_size, bsize, 7 )
+
+				repair_obj.calc_parity()
+				pdata_list.append( repair_obj.parity_data )
+
+			for pdata in pdata_list[1:]:
+				if( pdata != pdata_list[0] ):
+					err = err + 1
+
+			# each pair of planes covers every block exactly once
+			pdata = pdata_list[0]
+			for j in range(1,len(pdata)//2):
+				for i in range(bsize):
+					if( (pdata[0][i]^pdata[1][i]) != (pdata[2*j][i]^pdata[2*j+1][i]) ):
+						err = err + 1
+
+		self.assertEqual( err, 0 )
+
+	# check_engine quietly falls back to 'int' without numpy, so this would
+	# only be comparing 'int' against itself
+	@unittest.skipIf( xorengine.numpy is None, "numpy is not installed" )
+	def test_numpy_engine(self):
+		err = 0
+
+		for (ptype,nparity,bsize) in [ ('i',1,1000), ('i',3,1024), ('i',4,1024), ('x',0,256), ('x',0,1000) ]:
+			for nblks in [ 2,5,16,17,33 ]:
+				# odd-sized "file" so the last block is partial
+				file_size = nblks * bsize - 7
+
+				pdata_list = []
+				for engine in [ 'int','numpy' ]:
+					opts = utils.DefaultOpts()
+					opts['parity_type'] = ptype
+					opts['num_parity_disks'] = max( 1, nparity )
+					opts['block_size'] = bsize
+					opts['xor_engine'] = engine
+
+					repair_obj = repairObj.RepairObj( file_size, opts )
+					repair_obj.create_dummy_data()
+					repair_obj.data[:file_size] = make_pattern( file_size, bsize, 7 )
+					repair_obj.calc_parity()
+					pdata_list.append( [ bytes(p) for p in repair_obj.parity_data ] )
+
+				if( pdata_list[0] != pdata_list[1] ):
+					err = err + 1
+
+		self.assertEqual( err, 0 )
+
+	def test_hypercube_repair(self):
+		err = 0
+
+		opts = utils.DefaultOpts()
+		opts['parity_type'] = 'x'
+		bsize = 256
+		opts['block_size'] = bsize
+		nblks = 13
+		file_size = nblks * bsize - 7
+
+		good_obj = make_good_obj( file_size, opts, 7 )
+
+		# damage in any one block can be found and fixed from the parity alone
+		for b in range(nblks):
+			bad_obj = make_bad_obj( good_obj, opts, [ b*bsize, b*bsize+5 ] )
+
+			if( bad_obj.calc_repair(good_obj) != 0 ):
+				err = err + 1
+			if( bad_obj.data != good_obj.data ):
+				err = err + 1
+
+		# but not in two blocks
+		bad_obj = make_bad_obj( good_obj, opts, [ 0, bsize ] )
+		if( bad_obj.calc_repair(good_obj) == 0 ):
+			err = err + 1
+
+		self.assertEqual( err, 0 )
+
+	def test_hypercube_two_blocks(self):
+		err = 0
+
+		opts = utils.DefaultOpts()
+		opts['parity_type'] = 'x'
+		bsize = 256
+		opts['block_size'] = bsize
+		file_size = 2 * bsize
+
+		good_obj = make_good_obj( file_size, opts, 7 )
+
+		# a damaged plane in the .fr must not be "repaired" into the data
+		for p in [ 0, 1 ]:
+			fr_obj = repairObj.RepairObj( file_size, opts )
+			fr_obj.parity_data = [ bytearray(x) for x in good_obj.parity_data ]
+			fr_obj.disk_cksums = good_obj.disk_cksums
+			fr_obj.parity_data[p][3] ^= 0xff
+			data_obj = make_bad_obj( good_obj, opts, [] )
+			data_obj.calc_repair( fr_obj )
+			if( data_obj.data != good_obj.data ):
+				err = err + 1
+
+		# but a damaged block 0 can still be fixed
+		data_obj = make_bad_obj( good_obj, opts, [ 7 ] )
+		if( (data_obj.calc_repair(good_obj) != 0) or (data_obj.data != good_obj.data) ):
+			err = err + 1
+
+		self.assertEqual( err, 0 )
+
+	def test_hypercube_fast_verify(self):
+		err = 0
+
+		opts = utils.DefaultOpts()
+		opts['parity_type'] = 'x'
+		opts['block_size'] = 4096
+		opts['fast_verify'] = True
+
+		(fd,datfile) = tempfile.mkstemp()
+		os.write( fd, bytes( [ i%256 for i in range(1000) ] ) )
+		os.close( fd )
+		chkfile = datfile + '.fr'
+		try:
+			filerepair.create_from_file( datfile, chkfile, dict(opts) )
+			if( filerepair.verify_file(datfile,chkfile,dict(opts)) != 0 ):
+				err = err + 1
+			# a single-block file: the cksums "cover" it, but hypercube
+			# verify doesn't look at them, so fast mode has to check parity
+			with open( datfile, 'r+b' ) as f:
+				f.seek( 100 )
+				f.write( b'x' )
+			if( filerepair.verify_file(datfile,chkfile,dict(opts)) == 0 ):
+				err = err + 1
+		finally:
+			for f in [ datfile, chkfile ]:
+				if( os.path.exists(f) ):
+					os.remove( f )
+
+		self.assertEqual( err, 0 )
+
 	def test_reedsolo(self):
 		#print
 		err = 0
@@ -135,6 +390,834 @@ class repairObjTests( unittest.TestCase ):
 
 		self.assertEqual( err, 0 )
 
+	def test_reedsolo_repair(self):
+		err = 0
+
+		opts = utils.DefaultOpts()
+		opts['parity_type'] = 'r'
+
+		for nparity in [ 2,4 ]:
+			opts['num_parity_disks'] = nparity
+			bsize = 256
+			opts['block_size'] = bsize
+			file_size = 20 * bsize + 50
+
+			good_obj = make_good_obj( file_size, opts )
+
+			# known-bad disks are erasures, so we can fix one per parity disk
+			bad_obj = make_bad_obj( good_obj, opts, [ (3*d+1)*bsize+d for d in range(nparity) ] )
+
+			if( bad_obj.calc_repair(good_obj) != 0 ):
+				err = err + 1
+			if( bad_obj.data != good_obj.data ):
+				err = err + 1
+
+		self.assertEqual( err, 0 )
+
+	def test_reedsolo_stripes(self):
+		err = 0
+
+		opts = utils.DefaultOpts()
+		opts['parity_type'] = 'r'
+		opts['num_parity_disks'] = 2
+		bsize = 64
+		opts['block_size'] = bsize
+
+		# more than 255 disks, so there have to be multiple stripes
+		file_size = 600 * bsize + 10
+		bad_offsets = [ d*bsize for d in [ 0,252, 253,505, 506,599 ] ]
+
+		good_obj = make_good_obj( file_size, opts )
+
+		if( good_obj.num_stripes != 3 ):
+			err = err + 1
+
+		# two bad disks in each stripe
+		bad_obj = make_bad_obj( good_obj, opts, bad_offsets )
+
+		if( bad_obj.calc_repair(good_obj) != 0 ):
+			err = err + 1
+		if( bad_obj.data != good_obj.data ):
+			err = err + 1
+
+		# the same again, with the stripes spread over processes
+		opts['num_procs'] = 2
+		proc_obj = repairObj.RepairObj( file_size, opts )
+		proc_obj.data = good_obj.data
+		proc_obj.calc_parity()
+		if( proc_obj.parity_data != good_obj.parity_data ):
+			err = err + 1
+		bad_obj = make_bad_obj( good_obj, opts, bad_offsets )
+		if( (bad_obj.calc_repair(good_obj) != 0) or (bad_obj.data != good_obj.data) ):
+			err = err + 1
+
+		self.assertEqual( err, 0 )
+
+	def test_shared_opts(self):
+		err = 0
+
+		(fd,datfile) = tempfile.mkstemp()
+		os.write( fd, bytes( [ i%251 for i in range(40*256) ] ) )
+		os.close( fd )
+		chkfile = datfile + '.fr'
+		repfile = datfile + '.rep'
+		try:
+			opts = utils.DefaultOpts()
+			opts['parity_type'] = 'r'
+			opts['block_size'] = 256
+			opts['stripe_size'] = 5
+			filerepair.create_from_file( datfile, chkfile, dict(opts) )
+
+			# the .fr file's layout is used, but mustn't stick to the opts
+			# that the rest of an '*all' run shares
+			shared = utils.DefaultOpts()
+			filerepair.verify_file( datfile, chkfile, shared )
+			filerepair.repair_file( datfile, chkfile, repfile, shared )
+			if( (shared['stripe_size'] != 0) or (shared['parity_type'] != 'i') ):
+				err = err + 1
+		finally:
+			for f in [ datfile, chkfile, repfile ]:
+				if( os.path.exists(f) ):
+					os.remove( f )
+
+		self.assertEqual( err, 0 )
+
+	def test_mmap_repair(self):
+		err = 0
+
+		opts = utils.DefaultOpts()
+		opts['use_mmap'] = True
+		opts['parity_type'] = 'i'
+		opts['num_parity_disks'] = 2
+		bsize = 512
+		opts['block_size'] = bsize
+
+		# partial last block, so the zero-padding is "virtual"
+		file_size = 10 * bsize + 37
+		orig = make_pattern( file_size, bsize )
+		good_obj = make_good_obj( file_size, opts )
+
+		bad = bytearray( orig )
+		bad[3*bsize] ^= 0xff
+		bad[file_size-1] ^= 0xff
+
+		(fd,badfile) = tempfile.mkstemp()
+		os.write( fd, bad )
+		os.close( fd )
+		repfile = badfile + '.rep'
+		try:
+			bad_obj = repairObj.RepairObj( file_size, opts )
+			bad_obj.read_file( badfile )
+			if( len(bad_obj.get_block(10)) != bsize ):
+				err = err + 1
+			bad_obj.calc_cksums()
+			if( bad_obj.calc_repair(good_obj) != 0 ):
+				err = err + 1
+			bad_obj.write_file( repfile )
+
+			if( utils.read_bytearray_file(repfile) != orig ):
+				err = err + 1
+			# the repairs must not leak back into the original file
+			if( utils.read_bytearray_file(badfile) != bad ):
+				err = err + 1
+
+			# just the repaired blocks, copied and then in-place
+			if( sorted(bad_obj.repaired_blocks) != [ 3, 10 ] ):
+				err = err + 1
+			os.remove( repfile )
+			bad_obj.write_file_patched( badfile, repfile )
+			if( utils.read_bytearray_file(repfile) != orig ):
+				err = err + 1
+			bad_obj.write_blocks( badfile )
+			if( utils.read_bytearray_file(badfile) != orig ):
+				err = err + 1
+		finally:
+			os.remove( badfile )
+			if( os.path.exists(repfile) ):
+				os.remove( repfile )
+
+		self.assertEqual( err, 0 )
+
+	def test_inplace_bad_fr(self):
+		err = 0
+
+		opts = utils.DefaultOpts()
+		opts['parity_type'] = 'i'
+		opts['num_parity_disks'] = 1
+		opts['block_size'] = 512
+		opts['repair_mode'] = 'inplace'
+
+		file_size = 10 * 512
+		orig = make_pattern( file_size, 512 )
+		bad = bytearray( orig )
+		bad[3*512+5] ^= 0xff
+
+		(fd,badfile) = tempfile.mkstemp()
+		os.write( fd, orig )
+		os.close( fd )
+		chkfile = badfile + '.fr'
+		repfile = badfile + '.rep'
+		try:
+			filerepair.create_from_file( badfile, chkfile, opts )
+			# damage the parity (the last section of the .fr) as well as
+			# the file, so the rebuilt block comes out wrong
+			with open( chkfile, 'r+b' ) as f:
+				f.seek( -1, os.SEEK_END )
+				b = f.read( 1 )
+				f.seek( -1, os.SEEK_END )
+				f.write( bytes([ b[0]^0x01 ]) )
+			with open( badfile, 'wb' ) as f:
+				f.write( bad )
+
+			for mode in [ 'inplace', 'patch', 'copy' ]:
+				opts['repair_mode'] = mode
+				if( filerepair.repair_file(badfile,chkfile,repfile,dict(opts)) == 0 ):
+					err = err + 1
+				if( utils.read_bytearray_file(badfile) != bad ):
+					err = err + 1
+				if( os.path.exists(repfile) ):
+					err = err + 1
+		finally:
+			for f in [ badfile, chkfile, repfile ]:
+				if( os.path.exists(f) ):
+					os.remove( f )
+
+		self.assertEqual( err, 0 )
+
+	def test_lazy_parity(self):
+		err = 0
+
+		opts = utils.DefaultOpts()
+		opts['parity_type'] = 'r'
+		opts['num_parity_disks'] = 2
+		opts['block_size'] = 256
+		file_size = 20 * 256 + 3
+
+		good_obj = make_good_obj( file_size, opts, 7 )
+
+		(fd,chkfile) = tempfile.mkstemp()
+		os.close( fd )
+		try:
+			for fmt in [ 'binary', 'text' ]:
+				good_obj.fr_format = fmt
+				good_obj.write_parityfile( chkfile )
+
+				parity_obj = repairObj.RepairObj( 0, opts )
+				parity_obj.read_parityfile( chkfile )
+				if( parity_obj.disk_cksums != good_obj.disk_cksums ):
+					err = err + 1
+				# parity stays in the file until asked for
+				if( parity_obj.parity_data[0] != [] ):
+					err = err + 1
+				parity_obj.load_parity( [1] )
+				if( (parity_obj.parity_data[0] != []) or (parity_obj.parity_data[1] != good_obj.parity_data[1]) ):
+					err = err + 1
+				parity_obj.load_parity()
+				if( parity_obj.parity_data != good_obj.parity_data ):
+					err = err + 1
+		finally:
+			os.remove( chkfile )
+
+		self.assertEqual( err, 0 )
+
+	def test_fr_binary(self):
+		err = 0
+
+		# no fr_format, so whatever a library caller gets by default
+		opts = { 'parity_type':'r', 'num_parity_disks':2, 'block_size':256, 'stripe_size':8 }
+		file_size = 20 * 256 + 3
+		good_obj = make_good_obj( file_size, opts )
+
+		(fd,chkfile) = tempfile.mkstemp()
+		os.close( fd )
+		try:
+			for merkle in [ False, True ]:
+				good_obj.use_merkle = merkle
+				if( good_obj.write_parityfile(chkfile) != 0 ):
+					err = err + 1
+				raw = utils.read_bytearray_file( chkfile )
+				if( raw[:4] != repairObj.FR_MAGIC ):
+					err = err + 1
+
+				parity_obj = repairObj.RepairObj( 0, opts )
+				if( parity_obj.read_parityfile(chkfile) != 0 ):
+					err = err + 1
+				if( (parity_obj.parity_type,parity_obj.num_parity_disks,parity_obj.block_size,
+						parity_obj.file_size,parity_obj.stripe_size,parity_obj.cksum_algo)
+						!= ('r',2,256,file_size,8,good_obj.cksum_algo) ):
+					err = err + 1
+				if( parity_obj.has_merkle != merkle ):
+					err = err + 1
+				parity_obj.load_cksums()
+				parity_obj.load_parity()
+				if( parity_obj.disk_cksums != good_obj.disk_cksums ):
+					err = err + 1
+				if( parity_obj.parity_data != good_obj.parity_data ):
+					err = err + 1
+
+				# a version we don't know about has to be turned away
+				for version in [ 0, repairObj.FR_VERSION+1 ]:
+					bad = bytearray( raw )
+					bad[4:6] = version.to_bytes( 2, 'little' )
+					with open( chkfile, 'wb' ) as f:
+						f.write( bad )
+					parity_obj = repairObj.RepairObj( 0, opts )
+					if( parity_obj.read_parityfile(chkfile) == 0 ):
+						err = err + 1
+		finally:
+			os.remove( chkfile )
+
+		self.assertEqual( err, 0 )
+
+	def test_threaded_cksums(self):
+		opts = utils.DefaultOpts()
+		opts['block_size'] = 4096
+		file_size = 37 * 4096 + 100
+
+		objs = []
+		for nthreads in [ 1, 3 ]:
+			opts['hash_threads'] = nthreads
+			obj = repairObj.RepairObj( file_size, opts )
+			obj.create_dummy_data()
+			for i in range(0,file_size,101):
+				obj.data[i] = i % 251
+			obj.calc_cksums()
+			objs.append( obj )
+
+		self.assertEqual( objs[0].disk_cksums, objs[1].disk_cksums )
+
+	def test_read_ahead(self):
+		data = bytes( [ (i*31) % 256 for i in range(10*1000+7) ] )
+		(fd,file) = tempfile.mkstemp()
+		os.write( fd, data )
+		os.close( fd )
+		try:
+			serial = [ bytes(b) for b in utils.read_file_blocks(file,1000) ]
+			self.assertEqual( len(serial), 11 )
+			for io_mode in [ 'cached', 'nocache', 'direct' ]:
+				ahead = [ bytes(b) for b in utils.read_file_blocks(file,1000,3000,2,io_mode) ]
+				self.assertEqual( serial, ahead )
+				ahead = [ bytes(b) for b in utils.read_file_blocks(file,1000,0,0,io_mode) ]
+				self.assertEqual( serial, ahead )
+				self.assertEqual( utils.read_bytearray_file(file,io_mode), data )
+
+			# either option can be given without the other
+			opts = { 'parity_type':'i', 'num_parity_disks':1, 'block_size':1000, 'queue_depth':2 }
+			obj = repairObj.RepairObj( len(data), opts )
+			self.assertEqual( obj.stream_file(file), 0 )
+			self.assertEqual( (obj.read_size,obj.queue_depth), (0,2) )
+			del opts['queue_depth']
+			opts['read_size'] = 3000
+			obj = repairObj.RepairObj( len(data), opts )
+			self.assertEqual( (obj.read_size,obj.queue_depth), (3000,0) )
+
+			# stopping early must not leave the reader thread hanging
+			for blk in utils.read_file_blocks( file, 1000, 1000, 1 ):
+				break
+		finally:
+			os.remove( file )
+
+	def test_cksum_algos(self):
+		err = 0
+
+		# should match the usual crc32 check-value
+		algo = cksums.new_cksum( 'crc32' )
+		algo.update( b'123456789' )
+		if( algo.hexdigest() != 'cbf43926' ):
+			err = err + 1
+
+		opts = utils.DefaultOpts()
+		for (name,nbytes) in [ ('CRC32',4), ('ADLER32',4), ('BLAKE2B-64',8), ('SHA1',20) ]:
+			opts['cksum_algo'] = name
+			obj = repairObj.RepairObj( 3*4096, opts )
+			obj.create_dummy_data()
+			obj.calc_cksums()
+			if( obj.bytes_per_cksum != nbytes ):
+				err = err + 1
+			if( len(obj.disk_cksums[0]) != nbytes ):
+				err = err + 1
+
+		if( cksums.is_known('no-such-algo') ):
+			err = err + 1
+
+		self.assertEqual( err, 0 )
+
+	def test_merkle(self):
+		err = 0
+
+		opts = utils.DefaultOpts()
+		opts['block_size'] = 256
+		opts['merkle'] = True
+		file_size = 37 * 256 + 5
+
+		good_obj = make_good_obj( file_size, opts, 11 )
+
+		(fd,chkfile) = tempfile.mkstemp()
+		os.close( fd )
+		try:
+			good_obj.write_parityfile( chkfile )
+
+			for bad_disks in [ [], [0], [5,6,36], list(range(37)) ]:
+				bad_obj = make_bad_obj( good_obj, opts, [ d*256 for d in bad_disks ] )
+
+				parity_obj = repairObj.RepairObj( 0, opts )
+				parity_obj.read_parityfile( chkfile )
+				if( bad_obj.find_bad_disks(parity_obj) != bad_disks ):
+					err = err + 1
+				# only the tree was needed, not the whole cksum list
+				if( parity_obj.cksum_source is None ):
+					err = err + 1
+		finally:
+			os.remove( chkfile )
+
+		self.assertEqual( err, 0 )
+
+	def test_digest_table(self):
+		a = cksums.DigestTable( 10000, 4 )
+		b = cksums.DigestTable( 10000, 4 )
+		for d in range(10000):
+			a[d] = d.to_bytes( 4, 'big' )
+			b[d] = d.to_bytes( 4, 'big' )
+		self.assertEqual( a.mismatches(b), [] )
+
+		b[3] = b'\0\0\0\0'
+		b[9999] = b'\xff\xff\xff\xff'
+		self.assertEqual( a.mismatches(b,chunk=64), [ 3, 9999 ] )
+		self.assertEqual( a.hex(258), '00000102' )
+
+		# disks that the other table doesn't have are bad too
+		c = cksums.DigestTable( 9998, 4 )
+		c.load( a.buf[:9998*4] )
+		self.assertEqual( a.mismatches(c), [ 9998, 9999 ] )
+
+	def test_update(self):
+		err = 0
+
+		(fd,datfile) = tempfile.mkstemp()
+		os.close( fd )
+		(fd,chkfile) = tempfile.mkstemp()
+		os.close( fd )
+		try:
+			for ptype in [ 'i', 'r' ]:
+				opts = utils.DefaultOpts()
+				opts['parity_type'] = ptype
+				opts['num_parity_disks'] = 2
+				opts['block_size'] = 256
+				opts['stripe_size'] = 8
+				old_size = 13 * 256 + 100
+
+				old_obj = make_good_obj( old_size, opts, 7 )
+
+				# appended to (growing the last block and stripe), then
+				# appended to with a modified block
+				for (new_size,mod,append_only) in [ (old_size+1000,-1,True), (old_size+300,2,False) ]:
+					old_obj.write_parityfile( chkfile )
+					dat = bytearray( old_obj.data[:old_size] )
+					for i in range(old_size,new_size):
+						dat.append( (i*11) % 256 )
+					if( mod >= 0 ):
+						dat[mod*256+5] ^= 0xff
+					with open( datfile, 'wb' ) as f:
+						f.write( dat )
+
+					parity_obj = repairObj.RepairObj( 0, opts )
+					parity_obj.read_parityfile( chkfile )
+					new_obj = repairObj.RepairObj( new_size, opts )
+					new_obj.read_file( datfile )
+					if( new_obj.calc_update(parity_obj,append_only) != 0 ):
+						err = err + 1
+
+					good_obj = repairObj.RepairObj( new_size, opts )
+					good_obj.read_file( datfile )
+					good_obj.calc_parity()
+					good_obj.calc_cksums()
+					if( new_obj.parity_data != good_obj.parity_data ):
+						err = err + 1
+					if( new_obj.disk_cksums != good_obj.disk_cksums ):
+						err = err + 1
+
+				# a shrunken file can't be updated
+				parity_obj = repairObj.RepairObj( 0, opts )
+				parity_obj.read_parityfile( chkfile )
+				new_obj = repairObj.RepairObj( 100, opts )
+				if( new_obj.calc_update(parity_obj) != 1 ):
+					err = err + 1
+		finally:
+			os.remove( datfile )
+			os.remove( chkfile )
+
+		self.assertEqual( err, 0 )
+
+	def test_update_append(self):
+		err = 0
+
+		(fd,datfile) = tempfile.mkstemp()
+		os.close( fd )
+		chkfile = datfile + '.fr'
+		newfile = datfile + '.new.fr'
+		try:
+			for (ptype,stripe_size) in [ ('i',0), ('r',0), ('r',8) ]:
+				for old_size in [ 13*256+100, 40*256 ]:
+					opts = utils.DefaultOpts()
+					opts['parity_type'] = ptype
+					opts['num_parity_disks'] = 2
+					opts['block_size'] = 256
+					opts['stripe_size'] = stripe_size
+					new_size = old_size + 20*256 + 7
+					with open( datfile, 'wb' ) as f:
+						f.write( make_pattern(old_size,256) )
+					filerepair.create_from_file( datfile, chkfile, dict(opts) )
+					with open( datfile, 'wb' ) as f:
+						f.write( make_pattern(new_size,256) )
+
+					# only the old (partial) last block and the new ones
+					# may be read
+					parity_obj = repairObj.RepairObj( 0, opts )
+					parity_obj.read_parityfile( chkfile )
+					opts['stripe_size'] = parity_obj.stripe_size if (parity_obj.num_stripes > 1) else 0
+					new_obj = repairObj.RepairObj( new_size, opts )
+					new_obj.open_blocks( datfile )
+					if( new_obj.calc_update(parity_obj,True) != 0 ):
+						err = err + 1
+					if( min(new_obj.blocks_read) < (old_size // 256) ):
+						err = err + 1
+
+					# and the .fr file comes out the same as a fresh one
+					opts['append_only'] = True
+					if( filerepair.update_file(datfile,chkfile,dict(opts)) != 0 ):
+						err = err + 1
+					filerepair.create_from_file( datfile, newfile, dict(opts) )
+					if( utils.read_bytearray_file(chkfile) != utils.read_bytearray_file(newfile) ):
+						err = err + 1
+		finally:
+			for f in [ datfile, chkfile, newfile ]:
+				if( os.path.exists(f) ):
+					os.remove( f )
+
+		self.assertEqual( err, 0 )
+
+	def test_stat_cache(self):
+		err = 0
+
+		tmpdir = tempfile.mkdtemp()
+		datfile = os.path.join( tmpdir, 'foo' )
+		dbfile = os.path.join( tmpdir, 'state.db' )
+		try:
+			with open( datfile, 'wb' ) as f:
+				f.write( b'0123456789' )
+
+			cache = statcache.StatCache( dbfile )
+			(status,st) = cache.check( datfile )
+			if( status != statcache.NEW ):
+				err = err + 1
+			cache.record( datfile, st, verified=1000.0 )
+			(status,st) = cache.check( datfile )
+			if( status != statcache.FRESH ):
+				err = err + 1
+			cache.close()
+
+			# survives a re-open, and a write to the file shows up
+			with open( datfile, 'ab' ) as f:
+				f.write( b'abc' )
+			cache = statcache.StatCache( dbfile, reverify_days=1, reverify_max=1 )
+			(status,st) = cache.check( datfile )
+			if( status != statcache.CHANGED ):
+				err = err + 1
+			cache.record( datfile, st, verified=1000.0 )
+
+			# long-ago verifies are due again, but only reverify_max per run
+			(status,st) = cache.check( datfile )
+			if( status != statcache.STALE ):
+				err = err + 1
+			(status,st) = cache.check( datfile )
+			if( status != statcache.FRESH ):
+				err = err + 1
+			cache.close()
+		finally:
+			for f in os.listdir( tmpdir ):
+				os.remove( os.path.join(tmpdir,f) )
+			os.rmdir( tmpdir )
+
+		self.assertEqual( err, 0 )
+
+	def test_run_jobs(self):
+		err = 0
+
+		for num_jobs in [ 1, 3 ]:
+			finished = []
+			def done( task, rtn ):
+				finished.append( (task,rtn) )
+			# a generator, as from walk_files
+			tasks = ( i for i in range(50) )
+			rtn = utils.run_jobs( tasks, job_err, {}, num_jobs, done )
+			if( rtn != sum([ i%3 for i in range(50) ]) ):
+				err = err + 1
+			if( sorted(finished) != [ (i,i%3) for i in range(50) ] ):
+				err = err + 1
+
+		self.assertEqual( err, 0 )
+
+	def test_segments(self):
+		err = 0
+
+		(fd,datfile) = tempfile.mkstemp()
+		os.close( fd )
+		try:
+			file_size = 45 * 512 + 77
+			with open( datfile, 'wb' ) as f:
+				f.write( make_pattern(file_size,512) )
+
+			for (ptype,nparity) in [ ('i',2), ('i',3), ('r',2) ]:
+				opts = utils.DefaultOpts()
+				opts['parity_type'] = ptype
+				opts['num_parity_disks'] = nparity
+				opts['block_size'] = 512
+				opts['stripe_size'] = 7
+
+				good_obj = repairObj.RepairObj( file_size, opts )
+				good_obj.read_file( datfile )
+				good_obj.calc_parity()
+				good_obj.calc_cksums()
+
+				# segments that don't line up with the stripes/groups get
+				# rounded up so that they do
+				opts['num_procs'] = 2
+				opts['segment_size'] = 5000
+				for use_mmap in [ False, True ]:
+					opts['use_mmap'] = use_mmap
+					seg_obj = repairObj.RepairObj( file_size, opts )
+					if( not seg_obj.can_segment() ):
+						err = err + 1
+					if( seg_obj.calc_segments(datfile) != 0 ):
+						err = err + 1
+					if( seg_obj.parity_data != good_obj.parity_data ):
+						err = err + 1
+					if( seg_obj.disk_cksums != good_obj.disk_cksums ):
+						err = err + 1
+
+			# a file that has shrunk just comes back short, rather than
+			# taking the process down
+			data = utils.read_file_range( datfile, 40*512, 10*512 )
+			if( (data is None) or (len(data) != 5*512+77) ):
+				err = err + 1
+			os.truncate( datfile, 512 )
+			if( utils.read_file_range(datfile,1024,512) != bytearray() ):
+				err = err + 1
+			if( repairObj.RepairObj(file_size,opts).read_file(datfile) != 0 ):
+				err = err + 1
+		finally:
+			os.remove( datfile )
+
+		self.assertEqual( err, 0 )
+
+	def test_stream_create(self):
+		err = 0
+
+		# partial last block (and for RS, a short last stripe)
+		file_size = 23 * 512 + 77
+		(fd,datfile) = tempfile.mkstemp()
+		os.write( fd, make_pattern(file_size,512) )
+		os.close( fd )
+		memfile = datfile + '.mem.fr'
+		strfile = datfile + '.str.fr'
+		try:
+			for (ptype,nparity) in [ ('i',1), ('i',3), ('r',2) ]:
+				for fmt in [ 'binary', 'text' ]:
+					opts = utils.DefaultOpts()
+					opts['parity_type'] = ptype
+					opts['num_parity_disks'] = nparity
+					opts['block_size'] = 512
+					opts['stripe_size'] = 8
+					opts['fr_format'] = fmt
+					opts['merkle'] = (fmt == 'binary')
+					filerepair.create_from_file( datfile, memfile, dict(opts) )
+
+					# reads that don't line up with the blocks, with and
+					# without the read-ahead thread
+					opts['streaming'] = True
+					for (read_size,queue_depth) in [ (1048576,2), (700,0), (700,3) ]:
+						opts['read_size'] = read_size
+						opts['queue_depth'] = queue_depth
+						filerepair.create_from_file( datfile, strfile, dict(opts) )
+						if( utils.read_bytearray_file(strfile) != utils.read_bytearray_file(memfile) ):
+							err = err + 1
+		finally:
+			for f in [ datfile, memfile, strfile ]:
+				if( os.path.exists(f) ):
+					os.remove( f )
+
+		self.assertEqual( err, 0 )
+
+	def test_stream_verify(self):
+		err = 0
+
+		file_size = 23 * 512 + 77
+		orig = make_pattern( file_size, 512 )
+		(fd,datfile) = tempfile.mkstemp()
+		os.close( fd )
+		chkfile = datfile + '.fr'
+		try:
+			for (ptype,merkle) in [ ('i',False), ('i',True), ('r',False), ('r',True) ]:
+				opts = utils.DefaultOpts()
+				opts['parity_type'] = ptype
+				opts['num_parity_disks'] = 2
+				opts['block_size'] = 512
+				opts['stripe_size'] = 8
+				opts['merkle'] = merkle
+				opts['verbose'] = 1
+				with open( datfile, 'wb' ) as f:
+					f.write( orig )
+				run_logged( filerepair.create_from_file, datfile, chkfile, dict(opts) )
+
+				for bad_disks in [ [], [3], [3,23] ]:
+					bad = bytearray( orig )
+					for d in bad_disks:
+						bad[d*512] ^= 0xff
+					with open( datfile, 'wb' ) as f:
+						f.write( bad )
+
+					opts['streaming'] = False
+					(mem_rtn,mem_bad) = run_logged( filerepair.verify_file, datfile, chkfile, dict(opts) )
+					opts['streaming'] = True
+					(str_rtn,str_bad) = run_logged( filerepair.verify_file, datfile, chkfile, dict(opts) )
+
+					if( (mem_rtn != str_rtn) or (mem_bad != str_bad) ):
+						err = err + 1
+					if( (mem_bad != bad_disks) or ((mem_rtn == 0) != (bad_disks == [])) ):
+						err = err + 1
+		finally:
+			for f in [ datfile, chkfile ]:
+				if( os.path.exists(f) ):
+					os.remove( f )
+
+		self.assertEqual( err, 0 )
+
+	def test_stream_repair(self):
+		err = 0
+
+		file_size = 23 * 512 + 77
+		orig = make_pattern( file_size, 512 )
+		(fd,datfile) = tempfile.mkstemp()
+		os.close( fd )
+		chkfile = datfile + '.fr'
+		repfile = datfile + '.rep'
+		try:
+			for (ptype,bad_disks) in [ ('i',[3,22]), ('r',[0,5,23]), ('x',[7]) ]:
+				opts = utils.DefaultOpts()
+				opts['parity_type'] = ptype
+				opts['num_parity_disks'] = 2
+				opts['block_size'] = 512
+				opts['stripe_size'] = 8
+				opts['streaming'] = True
+				with open( datfile, 'wb' ) as f:
+					f.write( orig )
+				filerepair.create_from_file( datfile, chkfile, dict(opts) )
+
+				# a healthy file isn't read again (or copied)
+				if( filerepair.repair_file(datfile,chkfile,repfile,dict(opts)) != 0 ):
+					err = err + 1
+				if( os.path.exists(repfile) ):
+					err = err + 1
+
+				bad = bytearray( orig )
+				for d in bad_disks:
+					bad[d*512+1] ^= 0xff
+				with open( datfile, 'wb' ) as f:
+					f.write( bad )
+
+				# only the damaged blocks get read back in
+				parity_obj = repairObj.RepairObj( 0, opts )
+				parity_obj.read_parityfile( chkfile )
+				opts['stripe_size'] = parity_obj.stripe_size
+				data_obj = repairObj.RepairObj( file_size, opts )
+				data_obj.stream_file( datfile )
+				disk_errors = []
+				if( ptype != 'x' ):
+					disk_errors = data_obj.find_bad_disks( parity_obj )
+				if( data_obj.calc_repair_streamed(parity_obj,datfile,disk_errors) != 0 ):
+					err = err + 1
+				if( sorted(set(data_obj.blocks_read)) != bad_disks ):
+					err = err + 1
+				if( sorted(data_obj.repaired_blocks) != bad_disks ):
+					err = err + 1
+
+				for mode in [ 'copy', 'patch', 'inplace' ]:
+					opts['repair_mode'] = mode
+					if( filerepair.repair_file(datfile,chkfile,repfile,dict(opts)) != 0 ):
+						err = err + 1
+					if( mode == 'inplace' ):
+						if( utils.read_bytearray_file(datfile) != orig ):
+							err = err + 1
+					elif( utils.read_bytearray_file(repfile) != orig ):
+						err = err + 1
+					if( os.path.exists(repfile) ):
+						os.remove( repfile )
+		finally:
+			for f in [ datfile, chkfile, repfile ]:
+				if( os.path.exists(f) ):
+					os.remove( f )
+
+		self.assertEqual( err, 0 )
+
+	def test_fast_verify(self):
+		err = 0
+
+		file_size = 23 * 512 + 77
+		orig = make_pattern( file_size, 512 )
+		(fd,datfile) = tempfile.mkstemp()
+		os.close( fd )
+		chkfile = datfile + '.fr'
+		try:
+			for streaming in [ False, True ]:
+				opts = utils.DefaultOpts()
+				opts['num_parity_disks'] = 2
+				opts['block_size'] = 512
+				opts['streaming'] = streaming
+				opts['verbose'] = 1
+				with open( datfile, 'wb' ) as f:
+					f.write( orig )
+				run_logged( filerepair.create_from_file, datfile, chkfile, dict(opts) )
+				opts['fast_verify'] = True
+
+				# clean, then a bad block that the cksums catch
+				if( run_logged(filerepair.verify_file,datfile,chkfile,dict(opts)) != (0,[]) ):
+					err = err + 1
+				bad = bytearray( orig )
+				bad[3*512+9] ^= 0xff
+				with open( datfile, 'wb' ) as f:
+					f.write( bad )
+				if( run_logged(filerepair.verify_file,datfile,chkfile,dict(opts)) != (-1,[3]) ):
+					err = err + 1
+
+				# damage just the parity (the last section of the .fr) ..
+				# the cksums all match, so fast mode doesn't notice
+				with open( datfile, 'wb' ) as f:
+					f.write( orig )
+				with open( chkfile, 'r+b' ) as f:
+					f.seek( -1, os.SEEK_END )
+					b = f.read( 1 )
+					f.seek( -1, os.SEEK_END )
+					f.write( bytes([ b[0]^0x01 ]) )
+				if( run_logged(filerepair.verify_file,datfile,chkfile,dict(opts))[0] != 0 ):
+					err = err + 1
+
+				# .. but once the size has changed (so the cksums don't cover
+				# the file, or not the same file) it has to check the parity
+				for new_size in [ file_size+1000, file_size-10 ]:
+					with open( datfile, 'wb' ) as f:
+						f.write( make_pattern(new_size,512) )
+					out = io.StringIO()
+					with contextlib.redirect_stdout( out ):
+						rtn = filerepair.verify_file( datfile, chkfile, dict(opts) )
+					if( (rtn == 0) or ('parity error' not in out.getvalue()) ):
+						err = err + 1
+		finally:
+			for f in [ datfile, chkfile ]:
+				if( os.path.exists(f) ):
+					os.remove( f )
+
+		self.assertEqual( err, 0 )
+
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
 if __name__ == '__main__':